@@ -0,0 +1,257 @@
+# Generates programs and measures the assembler on them.
+#
+# Run from the repository root:
+#   python bench/bench.py parse     Parser.parse() only, 6k and 20k lines
+#   python bench/bench.py memory    Memory held after compileFile()
+#   python bench/bench.py memo      Parser.parse() with the packrat memo table
+#   python bench/bench.py link      compileFile() and link() times
+#   python bench/bench.py relink    link() again on the same graph
+#   python bench/bench.py twopass   Deferred engine against --two-pass
+
+from __future__ import print_function
+import gc
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pdpy11.compiler import Compiler
+from pdpy11.compiler import deferred
+from pdpy11.compiler.parser import Parser
+
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+def generateParse(lines):
+	# Conventional code: labels, instructions with every addressing mode,
+	# data directives, local labels and comments, 10 lines per block
+	code = []
+	for i in range(lines // 10):
+		code.append("L{i}:\tMOV #L{i}+{j:o}, R0 ; load address".format(i=i, j=i % 64))
+		code.append("\tADD @(R1)+, -(R2)")
+		code.append("\tCMP {k}.(R3), @#177560".format(k=i % 100))
+		code.append("1:\tDEC R4")
+		code.append("\tBNE 1")
+		code.append("\tJSR PC, L{i}".format(i=i))
+		code.append("\t.WORD L{i} - L0 + 2, L{i} * 2, 177777".format(i=i))
+		code.append("\t.BYTE 1, 2, 3")
+		code.append("\t.ASCIZ /line {i}/".format(i=i))
+		code.append("\t.EVEN")
+	return "\n".join(code) + "\n"
+
+
+def benchParse():
+	for lines in (6000, 20000):
+		code = generateParse(lines)
+		best = None
+		for _ in range(3):
+			start = timer()
+			for _ in Parser("bench.mac", code, syntax="pdpy11").parse():
+				pass
+			elapsed = timer() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		print("parse {lines} lines: {time:.2f} s (best of 3)".format(lines=lines, time=best))
+
+
+def benchMemo():
+	# The memo table is only worth turning on if it has hits
+	code = generateParse(6000)
+	for memoize in (False, True):
+		best = None
+		for _ in range(3):
+			parser = Parser("bench.mac", code, syntax="pdpy11", memoize=memoize)
+			start = timer()
+			for _ in parser.parse():
+				pass
+			elapsed = timer() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		print("parse 6000 lines, memoize={memoize}: {time:.2f} s (best of 3), {hits} memo hits, {misses} misses".format(
+			memoize=memoize,
+			time=best,
+			hits=parser.memo_hits,
+			misses=parser.memo_misses
+		))
+
+
+def generateWords(labels, words):
+	# Every label is followed by words referring to itself, to the label
+	# before and to the one after it, so half of them are forward references
+	per_label = words // labels
+	code = []
+	for i in range(labels):
+		refs = ["L{i}".format(i=i), "L{n} - L{i}".format(i=i, n=(i + 1) % labels), "L{p} + 2".format(p=i - 1 if i else 0)]
+		code.append("L{i}:\t.WORD {refs}".format(i=i, refs=", ".join((refs * per_label)[:per_label])))
+	return "\n".join(code) + "\n"
+
+
+def generateBlkb(count):
+	# Each .BLKB is sized by a label defined only at the end, so every
+	# address after the first one depends on all the sizes before it
+	code = []
+	for i in range(count):
+		code.append("B{i}:\t.BLKB S{i}".format(i=i))
+	for i in range(count):
+		code.append("S{i} = {size}".format(i=i, size=i % 7 + 1))
+	return "\n".join(code) + "\n"
+
+
+def generateMixed(labels):
+	# Branches and words to labels before and after, as loops and jump
+	# tables look in real programs
+	code = []
+	for i in range(labels):
+		n = min(i + 1, labels - 1)
+		code.append("L{i}:\tTST R0".format(i=i))
+		code.append("\tBNE L{n}".format(n=n))
+		code.append("\tBR L{i}".format(i=i))
+		code.append("\tSOB R1, L{i}".format(i=i))
+		code.append("\tJMP L{n}".format(n=n))
+		code.append("\t.WORD L{n}, L{i} - L0".format(i=i, n=n))
+	return "\n".join(code) + "\n"
+
+
+def generatePrograms():
+	return (
+		("6000 lines of conventional code", generateParse(6000)),
+		("6000 labels, 30000 words", generateWords(6000, 30000)),
+		("5000 forward-sized .BLKB", generateBlkb(5000)),
+		("400 labels, mixed branches and words", generateMixed(400))
+	)
+
+
+def benchMemory():
+	import tracemalloc
+
+	for name, code in generatePrograms():
+		gc.collect()
+		tracemalloc.start()
+		compiler = Compiler()
+		compiler.compileFile("bench.mac", code)
+		gc.collect()
+		current, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		del compiler
+		print("{name}: {current:.1f} MB after compileFile(), peak {peak:.1f} MB".format(
+			name=name,
+			current=current / 1e6,
+			peak=peak / 1e6
+		))
+
+
+def benchLink():
+	for name, code in generatePrograms():
+		best_compile = None
+		best_link = None
+		for _ in range(3):
+			compiler = Compiler()
+			start = timer()
+			compiler.compileFile("bench.mac", code)
+			middle = timer()
+			compiler.link()
+			end = timer()
+			if best_compile is None or middle - start < best_compile:
+				best_compile = middle - start
+			if best_link is None or end - middle < best_link:
+				best_link = end - middle
+		print("{name}: compileFile() {compile:.2f} s, link() {link:.2f} s (best of 3)".format(
+			name=name,
+			compile=best_compile,
+			link=best_link
+		))
+
+
+def benchRelink():
+	# Once link() has evaluated the graph, evaluating it again (another
+	# link(), listings) should cost one call per value: the number of
+	# deferred.evaluate() calls made by the second link() is printed
+	evaluate = deferred.evaluate
+	calls = [0]
+	def countingEvaluate(node, context):
+		calls[0] += 1
+		return evaluate(node, context)
+
+	for name, code in generatePrograms():
+		compiler = Compiler()
+		compiler.compileFile("bench.mac", code)
+		values = sum(1 for _, value in compiler.writes if type(value) is not bytearray)
+
+		start = timer()
+		compiler.link()
+		middle = timer()
+		deferred.evaluate = countingEvaluate
+		calls[0] = 0
+		try:
+			compiler.link()
+		finally:
+			deferred.evaluate = evaluate
+		end = timer()
+
+		print("{name}: {values} fixups, first link() {first:.3f} s, second link() {second:.3f} s with {calls} evaluations".format(
+			name=name,
+			values=values,
+			first=middle - start,
+			second=end - middle,
+			calls=calls[0]
+		))
+
+
+def benchTwoPass():
+	# Compiles and links the programs with both engines, the output must be
+	# the same
+	directory = tempfile.mkdtemp()
+	try:
+		file = os.path.join(directory, "bench.mac")
+		for name, code in generatePrograms():
+			with io.open(file, "w", encoding="utf-8") as f:
+				f.write(code)
+
+			times = []
+			outputs = []
+			for two_pass in (False, True):
+				best = None
+				for _ in range(5):
+					compiler = Compiler(two_pass=two_pass)
+					start = timer()
+					compiler.compileRoots([file])
+					compiler.link()
+					elapsed = timer() - start
+					if best is None or elapsed < best:
+						best = elapsed
+				times.append(best)
+				outputs.append(compiler.output)
+
+			print("{name}: Deferred {deferred:.2f} s, two-pass {two_pass:.2f} s (best of 5), output {same}".format(
+				name=name,
+				deferred=times[0],
+				two_pass=times[1],
+				same="identical" if outputs[0] == outputs[1] else "DIFFERS"
+			))
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	what = sys.argv[1:] or ["parse", "memo", "memory", "link", "relink", "twopass"]
+	for name in what:
+		if name == "parse":
+			benchParse()
+		elif name == "memo":
+			benchMemo()
+		elif name == "memory":
+			benchMemory()
+		elif name == "link":
+			benchLink()
+		elif name == "relink":
+			benchRelink()
+		elif name == "twopass":
+			benchTwoPass()
+		else:
+			print("Unknown benchmark: {name}".format(name=name))
+			raise SystemExit(1)
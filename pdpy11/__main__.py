@@ -2,6 +2,8 @@ from __future__ import print_function
 import os
 import sys
 from .compiler import Compiler
+from .compiler.cache import ParseCache
+from .compiler.explain import Explainer
 from .compiler.util import encodeBinRawSavWav, setErrorMode, open_device
 
 if len(sys.argv) < 2:
@@ -50,6 +52,19 @@ if len(sys.argv) < 2:
 	print("""--sublime                       Output errors in Sublime-compatible format. This""")
 	print("""                                allows Sublime to show errors inline.           """)
 	print()
+	print("""--cache                         Save parsed files to .pdpy11cache directory and """)
+	print("""                                don't parse unchanged files again               """)
+	print()
+	print("""--two-pass                      Compute label addresses before compiling, so    """)
+	print("""                                that forward references are encoded right away. """)
+	print("""                                Programs whose sizes depend on labels defined   """)
+	print("""                                later are compiled as usual.                    """)
+	print()
+	print("""--explain-deferred[=json|dot]   Save the dependency graph of labels and writes, """)
+	print("""                                with evaluation times and chain depths, to      """)
+	print("""                                "file.deferred.json" (or .dot), and print the   """)
+	print("""                                slowest values and deepest chains               """)
+	print()
 	print("Directives:")
 	print("""ORG n / .LINK n / .LA n         Link file from N (replaces --link). However, if """)
 	print("""                                an included file contains .LINK, the included   """)
@@ -146,6 +161,9 @@ link = "1000"
 project = None
 defines = []
 do_lst = False
+cache = False
+explain = None
+two_pass = False
 
 args = sys.argv[1:]
 while len(args):
@@ -179,6 +197,17 @@ while len(args):
 		syntax = arg.replace("--syntax=", "")
 	elif arg == "--sublime":
 		setErrorMode(sublime=True)
+	elif arg == "--cache":
+		cache = True
+	elif arg == "--two-pass":
+		two_pass = True
+	elif arg == "--explain-deferred":
+		explain = "json"
+	elif arg.startswith("--explain-deferred="):
+		explain = arg.replace("--explain-deferred=", "")
+		if explain not in ("json", "dot"):
+			print("--explain-deferred format must be json or dot")
+			raise SystemExit(1)
 	elif arg[:2] == "-D":
 		name, value = arg[2:].split("=", 1)
 		str_punct = ("\"", "'", "/")
@@ -302,35 +331,60 @@ if project is not None:
 					file_list.append(file)
 
 
-compiler = Compiler(syntax=syntax, link=link, file_list=file_list, project=project)
+if cache:
+	cache = ParseCache(os.path.join(project if project is not None else os.getcwd(), ".pdpy11cache"))
+else:
+	cache = None
+
+if explain is not None:
+	explainer = Explainer()
+	explainer.install()
+else:
+	explainer = None
+
+compiler = Compiler(syntax=syntax, link=link, file_list=file_list, project=project, cache=cache, explainer=explainer, two_pass=two_pass)
 for name, value in defines:
 	compiler.define(name, value)
 
 if project is not None:
-	# Project mode
 	lstname = project
-	for ext, file, args, output, link_address in compiler.buildProject():
-		with open_device(file, "wb") as f:
-			f.write(encodeBinRawSavWav(ext, args, output, link_address))
 else:
-	# Single file mode
 	lstname = files[0]
 	if lstname.endswith(".mac"):
 		lstname = lstname[:-4]
-	for file in files:
-		compiler.include_root = os.path.abspath(file)
-		compiler.addFile(file)
 
-	out_files = compiler.link()
+linked = False
+try:
+	if project is not None:
+		# Project mode
+		for ext, file, args, output, link_address in compiler.buildProject():
+			with open_device(file, "wb") as f:
+				f.write(encodeBinRawSavWav(ext, args, output, link_address))
+	else:
+		# Single file mode
+		compiler.compileRoots(files)
+
+		out_files = compiler.link()
+
+		for ext, file, args in out_files:
+			with open_device(file, "wb") as f:
+				f.write(encodeBinRawSavWav(ext, args, compiler.output, compiler.link_address))
 
-	for ext, file, args in out_files:
-		with open_device(file, "wb") as f:
-			f.write(encodeBinRawSavWav(ext, args, compiler.output, compiler.link_address))
+		if len(out_files) == 0:
+			# No output file
+			with open_device(output, "wb") as f:
+				f.write(encodeBinRawSavWav(output_format or "bin", (), compiler.output, compiler.link_address))
 
-	if len(out_files) == 0:
-		# No output file
-		with open_device(output, "wb") as f:
-			f.write(encodeBinRawSavWav(output_format or "bin", (), compiler.output, compiler.link_address))
+	linked = True
+finally:
+	if explainer is not None:
+		# Written even if linking failed, that's when it's needed most
+		explainer.uninstall()
+		if explainer.labels is None:
+			explainer.snapshot(compiler)
+		explainer.build(linked)
+		explainer.write(lstname + ".deferred." + explain, explain)
+		explainer.printSummary()
 
 if do_lst:
 	with open(lstname + ".lst", "w") as f:
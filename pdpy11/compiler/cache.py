@@ -0,0 +1,258 @@
+import os
+import io
+import sys
+import pickle
+import hashlib
+from .parser import Parser, Mark
+from .util import LineIndex, Coords
+
+
+def getParserVersion():
+	# The cached stream contains objects from these modules, so any change to
+	# them invalidates the cache
+	h = hashlib.sha256()
+	h.update(repr(sys.version_info[:2]).encode())
+	directory = os.path.dirname(os.path.abspath(__file__))
+	for name in ("parser.py", "expression.py", "deferred.py", "util.py", "commands.py"):
+		with open(os.path.join(directory, name), "rb") as f:
+			h.update(f.read())
+	return h.hexdigest()
+
+
+def commonPrefixLength(a, b):
+	lo, hi = 0, min(len(a), len(b))
+	while lo < hi:
+		mid = (lo + hi + 1) // 2
+		if a[:mid] == b[:mid]:
+			lo = mid
+		else:
+			hi = mid - 1
+	return lo
+
+def commonSuffixLength(a, b, limit):
+	lo, hi = 0, min(len(a), len(b), limit)
+	while lo < hi:
+		mid = (lo + hi + 1) // 2
+		if a[len(a) - mid:] == b[len(b) - mid:]:
+			lo = mid
+		else:
+			hi = mid - 1
+	return lo
+
+
+class ParseCache(object):
+	# Stores the command streams produced by Parser.parse() on disk, so that
+	# files that didn't change since the last build are not parsed again.
+	# Entries are keyed by file name, file contents, syntax mode and parser
+	# version. Only the latest version of each file is kept: when a file is
+	# changed, it is reparsed incrementally from that version (see
+	# IncrementalParser).
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.version = getParserVersion()
+		self.hits = 0
+		self.misses = 0
+
+	def getPath(self, ext, *parts):
+		h = hashlib.sha256()
+		for part in (self.version,) + parts:
+			h.update(part.encode("utf-8"))
+			h.update(b"\x00")
+		return os.path.join(self.directory, h.hexdigest() + ext)
+
+	def open(self, file, code, syntax):
+		# Returns an object that behaves like Parser(file, code, syntax)
+		entry = self.load(self.getPath(".pickle", syntax, file, code))
+		if entry is not None:
+			self.hits += 1
+			return CachedParser(file, code, entry[1])
+
+		self.misses += 1
+		previous = None
+		try:
+			with open(self.getPath(".latest", syntax, file), "r") as f:
+				previous = self.load(os.path.join(self.directory, f.read()))
+		except IOError:
+			pass
+		return IncrementalParser(file, code, syntax, cache=self, previous=previous)
+
+	def load(self, path):
+		try:
+			with open(path, "rb") as f:
+				return pickle.load(f)
+		except (IOError, EOFError, pickle.UnpicklingError):
+			return None
+
+	def store(self, file, code, syntax, records):
+		path = self.getPath(".pickle", syntax, file, code)
+		latest_path = self.getPath(".latest", syntax, file)
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+
+			# Remove the previous version
+			try:
+				with open(latest_path, "r") as f:
+					previous_path = os.path.join(self.directory, f.read())
+				if previous_path != path:
+					os.unlink(previous_path)
+			except (IOError, OSError):
+				pass
+
+			self.write(path, pickle.dumps((code, records), pickle.HIGHEST_PROTOCOL))
+			self.write(latest_path, os.path.basename(path).encode())
+		except (IOError, OSError):
+			# Caching is an optimization only
+			pass
+
+	def write(self, path, data):
+		# Write to a temporary file first, so that an interrupted build doesn't
+		# leave a truncated entry
+		tmp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+		with open(tmp_path, "wb") as f:
+			f.write(data)
+		os.replace(tmp_path, path)
+
+
+class StreamUnpickler(pickle.Unpickler):
+	# Loads a command saved by IncrementalParser.
+	# . (dot) marks are numbered globally (see Parser.mark()), so they are
+	# renumbered, otherwise a file that is loaded twice in one build would
+	# define the same marks twice. Source coordinates are moved by shift
+	# characters and bound to the line index of the current code.
+
+	def __init__(self, f, index, shift):
+		pickle.Unpickler.__init__(self, f)
+		self.index = index
+		self.shift = shift
+		self.marks = {}
+
+	def find_class(self, module, name):
+		if module == Mark.__module__ and name == Mark.__name__:
+			return self.loadMark
+		elif module == LineIndex.__module__ and name == LineIndex.__name__:
+			return self.loadIndex
+		elif module == Coords.__module__ and name == Coords.__name__:
+			return self.loadCoords
+		return pickle.Unpickler.find_class(self, module, name)
+
+	def loadMark(self, mark):
+		if mark not in self.marks:
+			self.marks[mark] = Mark(".{last_mark}".format(last_mark=Parser.last_mark))
+			Parser.last_mark += 1
+		return self.marks[mark]
+
+	def loadIndex(self, code):
+		return self.index
+
+	def loadCoords(self, file, index, start, end):
+		return Coords(file, self.index, start + self.shift, end + self.shift)
+
+
+class IncrementalParser(Parser):
+	# Parses the file and records every command as (start, end, state
+	# before, state after, shift, pickled command). Commands are pickled as
+	# soon as they are produced, i.e. before the compiler evaluates (and
+	# caches) any of their values.
+	#
+	# If the records of the previous version of the file are passed, only
+	# the commands affected by the edit are parsed again: the commands before
+	# the edit are loaded, and after the edit, parsing stops as soon as it
+	# reaches the start of an old command with the same parser state.
+
+	def __init__(self, file, code, syntax, cache=None, previous=None):
+		super(IncrementalParser, self).__init__(file, code, syntax)
+		self.cache = cache
+		self.previous = previous
+		self.records = None
+		self.coords = None
+
+	def parse(self):
+		records = []
+		old_code, old_records = self.previous or ("", [])
+
+		prefix = commonPrefixLength(old_code, self.code)
+		suffix = commonSuffixLength(old_code, self.code, min(len(old_code), len(self.code)) - prefix)
+		delta = len(self.code) - len(old_code)
+
+		# Commands before the edit. The parser looks one token ahead, so the
+		# command after them must be unchanged too (the end of file doesn't
+		# count, it has no tokens).
+		reused = 0
+		while reused + 1 < len(old_records) and old_records[reused + 1][0] < old_records[reused + 1][1] < prefix:
+			reused += 1
+		for record in old_records[:reused]:
+			records.append(record)
+			yield self.load(record)
+		if reused > 0:
+			self.pos = old_records[reused - 1][1]
+			self.cmd_start = self.coords.start
+			self.decimal, self.syntax, self.last_label = old_records[reused - 1][3]
+
+		# Commands after the edit, by their start in the new code. The end of
+		# file is reported at the previous command, so it is never reused.
+		unchanged = {}
+		for i, record in enumerate(old_records):
+			if record[0] >= len(old_code) - suffix:
+				unchanged[record[0] + delta] = i
+
+		self.coords = None
+		start = self.pos
+		state = (self.decimal, self.syntax, self.last_label)
+		parsing = super(IncrementalParser, self).parse()
+		for command in parsing:
+			new_state = (self.decimal, self.syntax, self.last_label)
+			if records is not None:
+				try:
+					data = pickle.dumps((command, self.getCurrentCommandCoords()), pickle.HIGHEST_PROTOCOL)
+					records.append((start, self.pos, state, new_state, 0, data))
+				except (pickle.PicklingError, TypeError, AttributeError):
+					# Not cacheable
+					records = None
+			yield command
+
+			start = self.pos
+			state = new_state
+			i = unchanged.get(start)
+			if i is not None and old_records[i][2] == state and old_records[i][0] < old_records[i][1]:
+				# The rest of the file is the same as before
+				parsing.close()
+				for old_start, old_end, before, after, shift, data in old_records[i:]:
+					record = (old_start + delta, old_end + delta, before, after, shift + delta, data)
+					if records is not None:
+						records.append(record)
+					yield self.load(record)
+				break
+
+		self.records = records
+		if records is not None and self.cache is not None:
+			self.cache.store(self.file, self.code, self.syntax, records)
+
+	def load(self, record):
+		start, end, before, after, shift, data = record
+		command, self.coords = StreamUnpickler(io.BytesIO(data), self.lines, shift).load()
+		return command
+
+	def getCurrentCommandCoords(self):
+		if self.coords is not None:
+			return self.coords
+		return super(IncrementalParser, self).getCurrentCommandCoords()
+
+
+class CachedParser(object):
+	# Replays commands recorded by IncrementalParser
+
+	def __init__(self, file, code, records):
+		self.file = file
+		self.lines = LineIndex(code)
+		self.records = records
+		self.coords = None
+
+	def parse(self):
+		for start, end, before, after, shift, data in self.records:
+			command, self.coords = StreamUnpickler(io.BytesIO(data), self.lines, shift).load()
+			yield command
+
+	def getCurrentCommandCoords(self):
+		return self.coords
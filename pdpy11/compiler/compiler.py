@@ -1,32 +1,81 @@
 from __future__ import print_function
 import os
+import io
+import re
 import sys
 import string
 import random
-from collections import defaultdict
-from .parser import Parser, EndOfParsingError
+import contextlib
+import concurrent.futures
+from .parser import Parser, EndOfParsingError, scanDirectives
+from .cache import IncrementalParser, CachedParser
 from .deferred import Deferred
+from . import deferred
 from .commands import commands
 from . import util
+from . import twopass
 from .util import raiseCompilerError, A, R, D, I, R0, R1, R2, R3, R4, R5, SP, PC
 from .expression import Expression
 
+# Directives that make a file an include root in project mode
+make_directives = ("MAKE_RAW", "MAKE_BK0010_ROM", "MAKE_BIN", "MAKE_SAV", "MAKE_TURBO_WAV", "MAKE_WAV")
+
+# Suffix of labels defined inside .REPEAT, see Compiler.handleCommand()
+repeat_suffix_re = re.compile(r": \.REPEAT\([a-z]+\)\[([0-9]+)\]")
+
+def parseProjectFile(file, code, syntax, cache, sublime):
+	# Parses a project file inside a worker process (see
+	# Compiler.buildProject). Returns the recorded commands, or None if the
+	# file couldn't be parsed -- the error is then reported when the file is
+	# compiled -- and the cache hits and misses of the worker, which only
+	# has a copy of the cache.
+	util.setErrorMode(sublime=sublime)
+
+	if cache is None:
+		parser = IncrementalParser(file, code, syntax)
+		hits, misses = 0, 0
+	else:
+		hits, misses = cache.hits, cache.misses
+		parser = cache.open(file, code, syntax)
+		hits, misses = cache.hits - hits, cache.misses - misses
+
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			for _ in parser.parse():
+				pass
+	except SystemExit:
+		return None, hits, misses
+
+	return parser.records, hits, misses
+
+
 class Compiler(object):
-	def __init__(self, syntax="pdpy11", link=0o1000, file_list=[], project=None):
+	def __init__(self, syntax="pdpy11", link=0o1000, file_list=[], project=None, cache=None, explainer=None, two_pass=False):
 		self.syntax = syntax
+		self.cache = cache
+		self.explainer = explainer
+		self.parsed = {}
 		self.link_address = link
 		self.file_list = file_list
 		self.project = project
-		self.global_labels = {}
+		self.global_labels = util.SymbolTable()
 		self.labels = self.global_labels
+		# Where labels are defined, for link errors
+		self.label_coords = {}
 		self.PC = link
 		self.linkPC = link
 		self.all_build = []
 		self.build = []
-		self.writes = []
+		self.writes = util.WriteLog()
 		self.extern_labels = False
 		self.included_before = set()
-		self.last_static_alloc = Expression("MEMORY", "STATIC_ALLOC", 0, 0)
+		self.last_static_alloc = Expression("MEMORY", "STATIC_ALLOC", {"line": 0, "column": 0})
+		self.interned = {}
+		self.two_pass = two_pass
+		# Label values computed by pass 1 of the two-pass engine, and the
+		# commands it parsed (see twopass.py)
+		self.predicted = None
+		self.replays = {}
 
 	def define(self, name, value):
 		value_text = "\"{str}\"".format(str=value) if isinstance(value, str) else value
@@ -39,45 +88,32 @@ class Compiler(object):
 				"text": "-D{name}={value}".format(name=name, value=value_text)
 			}, "Duplicate label {label}".format(label=name))
 
-		self.global_labels[name.upper()] = value
+		self.global_labels.define(None, name.upper(), value)
 
 	def generateLst(self):
-		by_files = defaultdict(lambda: [])
-		for label in self.labels:
-			# Convert string like this: "A: B: C: D: E:F: G: H: I: J"
-			# To this: file "A: B: C: D: E", label "F: G: H: I: J"
-
-			parts = label.split(": ")
-			label_parts = []
-			file_parts = []
-			for i in range(len(parts) - 1, -1, -1):
-				part = parts[i]
-				splitted = part.rsplit(":", 1)
-				label_parts.append(splitted[-1])
-				if len(splitted) > 1:
-					file_parts.append(splitted[0])
-					break
-			file_name = ": ".join(parts[:i] + file_parts)
-			label_name = ": ".join(label_parts[::-1])
-
-			if not file_name:
-				# Global label
-				continue
-			elif ": " in label_name:
-				# Local label
-				continue
-			elif label_name.startswith("."):
-				# . simulation
-				continue
-
-			# Collect labels per file
-			label_value = Deferred(self.labels[label], int)(self)
-			by_files[file_name].append((label_value, label_name))
+		by_files = []
+		for file_name, keys in self.labels.keys_by_file.items():
+			labels = []
+			for position, key in keys:
+				_, scope, name = self.labels.records[key]
+				if scope is not None:
+					# Local label
+					continue
+				elif name.startswith("."):
+					# . simulation
+					continue
+
+				label_value = Deferred(self.labels[key], int)(self)
+				labels.append((position, label_value, name))
+
+			if labels:
+				# Files are listed in the order their first labels are
+				by_files.append((labels[0][0], file_name, labels))
 
 		# Output
-		for file_name, labels in by_files.items():
+		for _, file_name, labels in sorted(by_files):
 			yield file_name
-			for value, name in sorted(labels):
+			for _, value, name in sorted(labels, key=lambda label: label[1:]):
 				text_value = util.octal(value)
 				# Pad to 6 chars
 				text_value = "0" * (6 - len(text_value)) + text_value
@@ -88,32 +124,92 @@ class Compiler(object):
 		# Add all files inside project directory that have
 		# make_raw or make_bk0010_rom directive
 		to_make = set()
+		codes = {}
 		for file in self.file_list:
 			# Read file
 			with open(file, "r", encoding="utf-8") as f:
 				code = f.read()
 
-			# Parse it
+			# Scan it
 			print("Parsing", file)
-			parser = Parser(file, code, syntax=self.syntax)
-
-			for (command, arg), labels in parser.parse():
-				if command in (
-					".MAKE_RAW", ".MAKE_BIN", ".MAKE_SAV", ".MAKE_TURBO_WAV", ".MAKE_WAV"
-				):
+			for directive in scanDirectives(code, self.syntax):
+				if directive in make_directives:
 					to_make.add(file)
+					codes[file] = code
+					break
+
+		# Include roots are going to be compiled anyway, so parse them in
+		# parallel now and reuse the results
+		for file, records in zip(codes, self.parseFiles(codes)):
+			if records is not None:
+				self.parsed[file] = (codes[file], records)
+
+		self.compileRoots(list(to_make))
+
+		print("Linking")
+		return self.link()
+
+
+	def compileRoots(self, roots):
+		# Compiles include roots: files passed in single file mode, or
+		# project files with make_* directives. Runs once, on a new Compiler.
+		if self.two_pass:
+			prediction = twopass.predict(self, roots)
+			if prediction is not None:
+				labels = self.labels.copy()
+				label_coords = dict(self.label_coords)
+				state = (self.PC, self.linkPC, self.link_address, set(self.included_before), self.last_static_alloc)
+
+				self.predicted, self.replays = prediction
+				output = io.StringIO()
+				try:
+					with contextlib.redirect_stdout(output):
+						self.compileRootsOnce(roots)
+					for key in self.predicted:
+						if key not in self.labels:
+							raise twopass.Misprediction()
+				except (twopass.Misprediction, SystemExit):
+					# Start again with the Deferred engine, which also
+					# reports errors the usual way
+					self.global_labels = labels
+					self.labels = labels
+					self.label_coords = label_coords
+					self.PC, self.linkPC, self.link_address, self.included_before, self.last_static_alloc = state
+					self.writes = util.WriteLog()
+					self.build = []
+					self.all_build = []
+					self.interned = {}
+				else:
+					sys.stdout.write(output.getvalue())
+					return
+				finally:
+					self.predicted = None
+					self.replays = {}
+
+		self.compileRootsOnce(roots)
+
+	def compileRootsOnce(self, roots):
+		if self.project is None:
+			# Single file mode, all files are linked together
+			for file in roots:
+				self.include_root = os.path.abspath(file)
+				self.addFile(file)
+			return
 
 		# All these files are separate project roots,
 		# just with common extern labels
-		for file in to_make:
+		for file in roots:
 			# By default, build file from 1000
 			self.link_address = 0o1000
 			self.PC = self.link_address
 			self.linkPC = self.link_address
 
 			# No writes, no build
-			self.writes = []
+			self.writes = util.WriteLog()
 			self.build = []
+			# Shared values are only kept while a root is compiled, so that
+			# they don't pile up over all roots of a big project
+			self.interned = {}
 
 			# Compile file
 			print("Compiling", file, "as include root")
@@ -131,9 +227,6 @@ class Compiler(object):
 
 				self.all_build.append((ext, name, args, self.writes, self.link_address))
 
-		print("Linking")
-		return self.link()
-
 
 
 	def addFile(self, file, relative_to=None):
@@ -165,49 +258,211 @@ class Compiler(object):
 			return os.path.abspath(os.path.join(base, file))
 
 	def link(self):
-		for label in self.labels:
-			Deferred(self.labels[label], int)(self)
+		if self.explainer is not None:
+			self.explainer.snapshot(self)
+
+		self.resolveLabels()
 
 		if self.project is not None:
 			all_build = []
 			for ext, file, args, writes, link_address in self.all_build:
-				array = []
-				for addr, value in writes:
-					value = Deferred(value, any)(self)
-
-					if not isinstance(value, list):
-						value = [value]
-
-					addr = Deferred(addr, int)(self)
-					for i, value1 in enumerate(value):
-						if addr + i >= len(array):
-							array += [0] * (addr + i - len(array) + 1)
-						array[addr + i] = value1
-
+				image = self.resolveWrites(writes)
 				link_address = Deferred(link_address, int)(self)
-				all_build.append((ext, file, tuple(Deferred(arg)(self) for arg in args), array[link_address:], link_address))
+				all_build.append((ext, file, tuple(Deferred(arg)(self) for arg in args), image.read(link_address), link_address))
 
 			return all_build
 		else:
-			array = []
-			for addr, value in self.writes:
-				value = Deferred(value, any)(self)
+			image = self.resolveWrites(self.writes)
+			self.link_address = Deferred(self.link_address, int)(self)
+			self.output = image.read(self.link_address)
+			return [(ext, name, tuple(Deferred(arg)(self) for arg in args)) for ext, name, args in self.build]
+
+	def resolveLabels(self):
+		# Replace labels with their values, so that writes read them without
+		# evaluating anything. evaluate() goes down to the values a label
+		# depends on first, and the label's own Deferred is evaluated (not a
+		# copy), so it's cached for the labels and writes sharing it: each
+		# value is computed once, in dependency order.
+		for label, value in self.labels.items():
+			if not isinstance(value, Deferred):
+				continue
+			try:
+				self.labels[label] = value(self)
+			except OverflowError:
+				cycle = self.findLabelCycle(label)
+				if cycle is None:
+					raise
+
+				# Start at a label named in the source, not at . or a label
+				# inside .REPEAT
+				for i, name in enumerate(cycle[:-1]):
+					if self.labels.getName(name) == self.describeLabel(name):
+						cycle = cycle[i:-1] + cycle[:i + 1]
+						break
+
+				coords = self.label_coords[cycle[0]]
+				self.err(
+					coords,
+					"Label {label} is recursively defined: {cycle}".format(
+						label=self.describeLabel(cycle[0]),
+						cycle=" -> ".join(self.describeLabel(name, coords["file"]) for name in cycle)
+					)
+				)
 
+	def describeLabel(self, key, file=None):
+		# Label name for messages. . is shown with its place, labels inside
+		# .REPEAT with the iteration and labels from another file than file
+		# with the file.
+		name = self.labels.getName(key)
+		coords = self.label_coords[key]
+		notes = []
+		iterations = repeat_suffix_re.findall(name)
+		if iterations:
+			name = repeat_suffix_re.sub("", name)
+			notes.append(".REPEAT iteration {idx}".format(idx=", ".join(str(int(idx) + 1) for idx in iterations)))
+		if name.startswith("."):
+			name = "."
+			notes.append("{file}:{line}".format(file=coords["file"], line=coords["line"]))
+		elif file is not None and coords["file"] != file:
+			notes.append(coords["file"])
+
+		if notes:
+			return "{name} ({notes})".format(name=name, notes=", ".join(notes))
+		else:
+			return name
+
+	def findLabelCycle(self, label):
+		# Returns the names of labels on a dependency cycle reachable from
+		# the label, starting and ending with the label if it's on the cycle,
+		# or None. Depth-first search without recursion, chains of labels
+		# may be as long as the program.
+		owner = {}
+		# substituteLabels() folds a label into the values that use it, e.g.
+		# B = A + 1 becomes a copy of A's value with + 1 added. The copy
+		# shares f with A's value, so that's how A is found on the path.
+		f_owner = {}
+		for name, value in self.labels.items():
+			if isinstance(value, Deferred):
+				owner.setdefault(id(value), name)
+				f_owner.setdefault(id(value.f), name)
+
+		def getNames(value, name):
+			# Labels passed through when value is reached by the name
+			names = [name]
+			base = f_owner.get(id(value.f))
+			if base is not None and base != name:
+				names.append(base)
+			return names
+
+		value = self.labels[label]
+		# id -> True while visiting, False when done
+		visiting = {id(value): True}
+		stack = [(value, deferred.dependencies(value), getNames(value, label))]
+		while stack:
+			node, deps, _ = stack[-1]
+			for dep in deps:
+				# Several labels may share a value, so the name is the one the
+				# value is referenced by
+				name = None
+				if isinstance(dep, Expression.Get):
+					value = dep.lookup(self.labels)
+					if not isinstance(value, Deferred):
+						continue
+					dep, name = value, dep.key
+				elif not isinstance(dep, Deferred) or dep.cached:
+					continue
+				names = getNames(dep, name or owner.get(id(dep)))
+
+				state = visiting.get(id(dep))
+				if state is None:
+					visiting[id(dep)] = True
+					stack.append((dep, deferred.dependencies(dep), names))
+					break
+				elif state:
+					start = [id(frame[0]) for frame in stack].index(id(dep))
+					cycle = [name for frame in stack[start:] for name in frame[2]]
+					if names[0] != cycle[0]:
+						# dep is reached by another name of the first label
+						cycle.append(names[0])
+					cycle = [name for name in cycle if name is not None]
+					if not cycle:
+						continue
+					if label in cycle:
+						i = cycle.index(label)
+						cycle = cycle[i:] + cycle[:i]
+					# A label folded into itself is passed through once
+					cycle = [name for i, name in enumerate(cycle) if i == 0 or name != cycle[i - 1]]
+					if len(cycle) > 1 and cycle[-1] == cycle[0]:
+						cycle.pop()
+					if cycle[0] in self.label_coords:
+						return cycle + [cycle[0]]
+			else:
+				stack.pop()
+				visiting[id(node)] = False
+		return None
+
+	def resolveWrites(self, writes):
+		image = util.MemoryImage()
+		for addr, value in writes:
+			if type(value) is util.Fill:
+				value = bytearray(self.evaluate(value.length))
+				addr = self.evaluate(addr)
+			elif type(value) is not bytearray:
+				# A fixup
+				value = self.evaluate(value)
 				if not isinstance(value, list):
 					value = [value]
+				addr = self.evaluate(addr)
 
-				addr = Deferred(addr, int)(self)
-				for i, value1 in enumerate(value):
-					if addr + i >= len(array):
-						array += [0] * (addr + i - len(array) + 1)
-					array[addr + i] = value1
+			image.write(addr, value)
+		return image
 
-			self.link_address = Deferred(self.link_address, int)(self)
-			self.output = array[self.link_address:]
-			return [(ext, name, tuple(Deferred(arg)(self) for arg in args)) for ext, name, args in self.build]
+	def evaluate(self, value):
+		# Unlike Deferred(value)(self), this caches the result in the value
+		# itself, so that evaluating it again (another link(), listings)
+		# costs one call
+		if isinstance(value, Deferred):
+			return value(self)
+		else:
+			return value
+
+	def parseFiles(self, codes):
+		# Parse files in parallel. Without parallelism, there is no reason to
+		# parse the files in advance.
+		args = [(file, code, self.syntax, self.cache, util.error_mode_sublime) for file, code in codes.items()]
+		if len(args) > 1 and (os.cpu_count() or 1) > 1:
+			try:
+				with concurrent.futures.ProcessPoolExecutor() as pool:
+					results = list(pool.map(parseProjectFile, *zip(*args)))
+				if self.cache is not None:
+					self.cache.hits += sum(hits for _, hits, _ in results)
+					self.cache.misses += sum(misses for _, _, misses in results)
+				return [records for records, _, _ in results]
+			except (NotImplementedError, OSError):
+				# No multiprocessing support
+				pass
+		return [None] * len(args)
+
+	def createParser(self, file, code):
+		if file in self.replays:
+			# Pass 2 of the two-pass engine
+			replay = self.replays[file]
+			if replay.code == code:
+				return twopass.ReplayParser(file, replay)
+
+		if file in self.parsed:
+			# Already parsed by buildProject()
+			parsed_code, records = self.parsed[file]
+			if parsed_code == code:
+				return CachedParser(file, code, records)
+
+		if self.cache is None:
+			return Parser(file, code, syntax=self.syntax)
+		else:
+			return self.cache.open(file, code, self.syntax)
 
 	def compileFile(self, file, code):
-		parser = Parser(file, code, syntax=self.syntax)
+		parser = self.createParser(file, code)
 
 		extern_labels = self.extern_labels
 
@@ -248,38 +503,28 @@ class Compiler(object):
 			pass
 		elif command == ".BYTE":
 			for byte in arg:
-				self.writeByte(byte, coords)
+				self.writeByte(self.substituteLabels(byte), coords)
 		elif command == ".WORD":
 			for word in arg:
-				self.writeWord(word, coords)
+				self.writeWord(self.substituteLabels(word), coords)
 		elif command == ".DWORD":
 			for dword in arg:
-				self.writeDword(dword, coords)
+				self.writeDword(self.substituteLabels(dword), coords)
 		elif command == ".END":
 			raise EOFError()
 		elif command == ".BLKB":
-			bytes_ = Deferred.Repeat(arg, 0)
-			self.writeBytes(bytes_)
+			self.writeFill(self.substituteLabels(arg))
 		elif command == ".BLKW":
-			words = Deferred.Repeat(arg * 2, 0)
-			self.writeBytes(words)
+			self.writeFill(self.substituteLabels(arg) * 2)
 		elif command == ".EVEN":
-			self.writeBytes(
-				Deferred.If(
-					self.linkPC % 2 == 0,
-					[],
-					[0]
-				)
-			)
+			self.writeFill(self.linkPC % 2)
 		elif command == ".ALIGN":
-			self.writeBytes(
+			arg = self.substituteLabels(arg)
+			self.writeFill(
 				Deferred.If(
 					self.linkPC % arg == 0,
-					[],
-					Deferred.Repeat(
-						arg - self.linkPC % arg,
-						0
-					)
+					0,
+					arg - self.linkPC % arg
 				)
 			)
 		elif command == ".ASCII":
@@ -367,7 +612,7 @@ class Compiler(object):
 				)
 		elif command == ".EQU":
 			name, value = arg
-			self.defineLabel(parser.file, name, value, coords)
+			self.defineLabel(parser.file, name, self.substituteLabels(value), coords)
 		elif command == ".REPEAT":
 			count, repeat_commands = arg
 			count = Deferred(count, int)(self)
@@ -449,7 +694,7 @@ class Compiler(object):
 					else:
 						return offset
 
-				offset = arg[0].addr - self.linkPC - 2
+				offset = self.substituteLabels(arg[0].addr) - self.linkPC - 2
 				offset = (Deferred(offset, int)
 					.then(unalignedBranch, int)
 					.then(farBranch, int)
@@ -474,7 +719,7 @@ class Compiler(object):
 					else:
 						return value
 
-				value = (Deferred(arg[0].value, int)
+				value = (Deferred(self.substituteLabels(arg[0].value), int)
 					.then(bigImmediateValue, int)
 					.then(negativeImmediateValue, int)
 				)
@@ -519,7 +764,7 @@ class Compiler(object):
 					else:
 						return offset
 
-				offset = self.linkPC + 2 - arg[1].addr
+				offset = self.linkPC + 2 - self.substituteLabels(arg[1].addr)
 				offset = (Deferred(offset, int)
 					.then(unaligned, int)
 					.then(far, int)
@@ -538,7 +783,9 @@ class Compiler(object):
 				if isinstance(arg1, A) and arg1.imm is not None:
 					additional = arg1.imm
 					if getattr(additional, "isOffset", False):
-						additional = additional - self.linkPC - 2
+						additional = self.substituteLabels(additional) - self.linkPC - 2
+					else:
+						additional = self.substituteLabels(additional)
 
 					self.writeWord(additional, coords)
 
@@ -573,9 +820,12 @@ class Compiler(object):
 			else:
 				return byte
 
-		byte = Deferred(byte, int).then(valueToByte, int)
+		if type(byte) is int:
+			byte = valueToByte(byte)
+		else:
+			byte = Deferred(byte, int).then(valueToByte, int)
 
-		self.writes.append((self.PC, byte))
+		self.writes.append(self.PC, byte)
 		self.PC = self.PC + 1
 		self.linkPC = self.linkPC + 1
 
@@ -590,10 +840,17 @@ class Compiler(object):
 			else:
 				return word
 
-		word = Deferred(word, int).then(valueToWord, int)
+		def wordToBytes(word):
+			return [word & 0xFF, word >> 8]
 
-		self.writes.append((self.PC, word & 0xFF))
-		self.writes.append((self.PC + 1, word >> 8))
+		if type(word) is int:
+			word = valueToWord(word)
+			self.writes.append(self.PC, word & 0xFF)
+			self.writes.append(self.PC + 1, word >> 8)
+		else:
+			# One write for both bytes, so that the word is evaluated once
+			word = Deferred(word, int).then(valueToWord, int).then(wordToBytes, list)
+			self.writes.append(self.PC, word)
 		self.PC = self.PC + 2
 		self.linkPC = self.linkPC + 2
 
@@ -608,19 +865,44 @@ class Compiler(object):
 			else:
 				return dword
 
-		dword = Deferred(dword, int).then(valueToDword, int)
+		if type(dword) is int:
+			dword = valueToDword(dword)
+		else:
+			dword = Deferred(dword, int).then(valueToDword, int)
 
-		self.writes.append((self.PC, (dword >> 16) & 0xFF))
-		self.writes.append((self.PC + 1, dword >> 24))
-		self.writes.append((self.PC + 2, dword & 0xFF))
-		self.writes.append((self.PC + 3, (dword >> 8) & 0xFF))
+		self.writes.append(self.PC, (dword >> 16) & 0xFF)
+		self.writes.append(self.PC + 1, dword >> 24)
+		self.writes.append(self.PC + 2, dword & 0xFF)
+		self.writes.append(self.PC + 3, (dword >> 8) & 0xFF)
 		self.PC = self.PC + 4
 		self.linkPC = self.linkPC + 4
 
 	def writeBytes(self, bytes_):
-		self.writes.append((self.PC, bytes_))
-		self.PC = self.PC + Deferred(bytes_, list).then(len, int)
-		self.linkPC = self.linkPC + Deferred(bytes_, list).then(len, int)
+		self.writes.append(self.PC, bytes_)
+		length = Deferred(bytes_, list).then(len, int)
+		if length.cached:
+			# Keep . an int if it is known
+			length = length.cache
+		self.PC = self.PC + length
+		self.linkPC = self.linkPC + length
+
+	def writeFill(self, length):
+		# Writes length zero bytes. The bytes are only created by link(), so
+		# that . can be moved by a Deferred length without building a list.
+		def nonNegative(length):
+			# Like [0] * length
+			return max(length, 0)
+
+		if type(length) is int:
+			length = nonNegative(length)
+		else:
+			length = Deferred(length, int).then(nonNegative, int)
+			if length.cached:
+				length = length.cache
+
+		self.writes.appendFill(self.PC, length)
+		self.PC = self.PC + length
+		self.linkPC = self.linkPC + length
 
 	def writeWords(self, words):
 		def wordsToBytes(words):
@@ -651,6 +933,10 @@ class Compiler(object):
 
 
 	def defineLabel(self, file_id, name, value, coords):
+		if isinstance(value, Deferred) and value.cached:
+			# Already known, so uses of the label can be encoded right away
+			value = value.cache
+
 		extern = False
 		if self.extern_labels is True:
 			# .EXTERN ALL
@@ -664,13 +950,13 @@ class Compiler(object):
 		if extern:
 			# Check that there is no file where such local label is
 			# defined.
-			for label in self.labels:
-				if label.endswith(":{name}".format(name=name)):
-					self.err(
-						coords,
-						("Duplicate global label {name} with local " +
-						"label defined in {file_id}").format(name=name, file_id=label.rsplit(":", 1)[0])
-					)
+			local_file = self.labels.findLocal(name)
+			if local_file is not None:
+				self.err(
+					coords,
+					("Duplicate global label {name} with local " +
+					"label defined in {file_id}").format(name=name, file_id=local_file)
+				)
 
 			# Check that there is no file where such global label is
 			# defined.
@@ -680,7 +966,10 @@ class Compiler(object):
 					"Duplicate global label {name}".format(name=name)
 				)
 
-			self.labels[name] = value
+			self.labels.define(None, name, value)
+			self.label_coords[name] = coords
+			if self.predicted is not None:
+				self.checkPrediction(name, value)
 		else:
 			# Check that there is no file where such global label is
 			# defined.
@@ -699,7 +988,48 @@ class Compiler(object):
 				"Duplicate local label {name}".format(name=name)
 			)
 
-		self.labels[local_name] = value
+		self.labels.define(file_id, name, value)
+		self.label_coords[local_name] = coords
+		if self.predicted is not None:
+			self.checkPrediction(local_name, value)
+
+	def checkPrediction(self, name, value):
+		if name in self.predicted:
+			if type(value) is not int or value != self.predicted[name]:
+				raise twopass.Misprediction()
+
+	def substituteLabels(self, value):
+		# Replace labels that are already defined with their values, so that
+		# e.g. a backward branch offset is known before linking
+		if isinstance(value, Deferred):
+			return self.intern(value.substitute(self.lookupLabel))
+		else:
+			return value
+
+	def intern(self, value):
+		# The same forward reference, e.g. label + 2, is often used in many
+		# places. Such values are shared, so that each is evaluated once.
+		if not isinstance(value, Deferred) or value.cached:
+			return value
+		elif value.f.op is not None or not isinstance(value.f.l, Expression.Get):
+			return value
+		for optext, op, other, reverse in value.pending_math:
+			if type(other) is not int:
+				return value
+
+		label = value.f.l
+		key = (label.s, label.file_id, value.type, value.pending_math)
+		return self.interned.setdefault(key, value)
+
+	def lookupLabel(self, leaf):
+		if isinstance(leaf, Expression.Get):
+			value = leaf.lookup(self.labels)
+			if value is None and self.predicted is not None:
+				# Not defined yet, pass 1 knows where it will be
+				value = twopass.lookup(self.predicted, leaf)
+			return value
+		else:
+			return None
 
 	def static_alloc(self, byte_length):
 		address = self.last_static_alloc
@@ -1,5 +1,5 @@
+import sys
 import operator
-import inspect
 import types
 
 ops_signature = {
@@ -25,25 +25,25 @@ ops_signature = {
 }
 
 class Lambda(object):
-	def __init__(self, l, optext=None, op=None, r=None):
+	# Deferred, Lambda, Expression.Get and StaticAlloc.Get are always called
+	# with the compiler context. A plain function l declares whether it takes
+	# the context via takes_context when the Lambda is constructed.
+	takes_context = True
+
+	__slots__ = ("l", "optext", "op", "r", "pass_context")
+
+	def __init__(self, l, optext=None, op=None, r=None, takes_context=True):
 		self.l = l
 		self.optext = optext
 		self.op = op
 		self.r = r
-		self.repr_disabled = False
+		self.pass_context = getattr(l, "takes_context", takes_context)
 
 	def __call__(self, context):
-		if self.r is not None:
-			return self.op(call(self.l, context), call(self.r, context))
-		elif self.op is not None:
-			return self.op(call(self.l, context))
-		else:
-			return call(self.l, context)
+		return evaluate(self, context)
 
 	def __repr__(self):
-		if self.repr_disabled:
-			return "<Lambda>"
-		elif self.r is not None:
+		if self.r is not None:
 			return "({l!r} {op} {r!r})".format(l=self.l, op=self.getOpText(), r=self.r)
 		elif self.op is not None:
 			return "({op}{value!r})".format(op=self.getOpText(), value=self.l)
@@ -65,8 +65,50 @@ class Lambda(object):
 			return self.optext
 
 	def map(self, f):
-		return Lambda(f(self.l), self.optext, self.op, f(self.r))
-
+		return Lambda(f(self.l), self.optext, self.op, f(self.r), self.pass_context)
+
+	def substitute(self, f):
+		# See Deferred.substitute. Returns None if nothing changed.
+		if self.op is None:
+			if isinstance(self.l, (Deferred, Lambda)):
+				value = self.l.substitute(f)
+				return None if value is self.l else value
+			elif callable(self.l):
+				return f(self.l)
+			else:
+				return None
+		elif self.optext in arithmetic:
+			l = substitute(self.l, f)
+			r = substitute(self.r, f)
+			if l is self.l and r is self.r:
+				return None
+			elif self.r is not None:
+				return self.op(l, r)
+			else:
+				return self.op(l)
+		else:
+			return None
+
+
+# Operations that Deferred overloads, so they can be applied to Deferred
+# operands again
+arithmetic = (
+	"+", "-", "*", "//", "/", "%", "<<", ">>", "&", "|", "^",
+	"==", "!=", "<", ">", "<=", ">=", "~"
+)
+
+# Operations that can be reordered when both operands are ints
+commutative = ("+", "*", "&", "|", "^")
+
+# Operations that don't change an int operand, e.g. x + 0
+identities = {
+	"+": 0,
+	"<<": 0,
+	">>": 0,
+	"*": 1,
+	"|": 0,
+	"^": 0
+}
 
 def infix(text, op):
 	def infix(self, other):
@@ -76,6 +118,18 @@ def infix(text, op):
 				defer = Deferred(self, res_type)
 				defer.addPendingMath(text, op, other.cache, reverse=False)
 				return defer
+			elif text in ("+", "-") and self.isA(int) and other.isA(int):
+				# (a + n) + (b + m) = (a + b) + (n + m), so that the constant
+				# part is kept outside of the Lambda and can be merged with
+				# constants that follow
+				self, n = self.splitOffset()
+				other, m = other.splitOffset()
+				if text == "-" and self.isSameBase(other):
+					# (a + n) - (a + m) = n - m
+					return n - m
+				defer = Deferred(Lambda(self, text, op, other), int)
+				defer.addPendingMath("+", operator.add, op(n, m), reverse=False)
+				return defer
 			else:
 				res_type = ops_signature.get((self.type, text, other.type), any)
 				return Deferred(Lambda(self, text, op, other), res_type)
@@ -91,7 +145,11 @@ def rinfix(text, op):
 		# Object . Deferred
 		res_type = ops_signature.get((type(other), text, self.type), any)
 		defer = Deferred(self, res_type)
-		defer.addPendingMath(text, op, other, reverse=True)
+		if text in commutative and type(other) is int and self.isA(int):
+			# n + a = a + n, so that it can be merged with other constants
+			defer.addPendingMath(text, op, other, reverse=False)
+		else:
+			defer.addPendingMath(text, op, other, reverse=True)
 		return defer
 	return rinfix
 
@@ -106,87 +164,172 @@ def convert(tp):
 		return tp(self())
 	return convert
 
-def call(f, context):
-	if not callable(f):
-		return f
-
-	if isinstance(f, (Deferred, Lambda)):
-		f.repr_disabled = True
+def substitute(value, f):
+	if isinstance(value, Deferred):
+		return value.substitute(f)
+	else:
+		return value
+
+def dependencies(value):
+	# Yields the Deferred values and leaf callables (e.g. Expression.Get) a
+	# Deferred value is computed from, mostly in evaluation order. Lambdas,
+	# operands and closures of plain functions are looked through.
+	pending = [other for _, _, other, _ in reversed(value.pending_math)]
+	pending.append(value.f)
+	seen = set()
+	while pending:
+		item = pending.pop()
+		if id(item) in seen:
+			continue
+		seen.add(id(item))
+
+		if isinstance(item, Deferred):
+			yield item
+		elif isinstance(item, Lambda):
+			pending += [item.op, item.optext, item.r, item.l]
+		elif isinstance(item, (list, tuple)):
+			pending += reversed(item)
+		elif isinstance(item, types.FunctionType):
+			for cell in reversed(item.__closure__ or ()):
+				try:
+					pending.append(cell.cell_contents)
+				except ValueError:
+					# Empty cell
+					pass
+		elif callable(item):
+			yield item
+
+
+# Set to an explain.Explainer by --explain-deferred
+profiler = None
+
+def evaluate(node, context):
+	# Evaluates a tree of Deferred and Lambda nodes using an explicit stack
+	# instead of recursion, because chains like PC + len(...) + len(...) + ...
+	# are as long as the program. A frame is [node, stage, left operand].
+	frames = []
+	profile = profiler
+	if profile is not None:
+		mark = len(profile.stack)
 
 	try:
-		spec = inspect.getfullargspec(f)
-	except TypeError:
-		spec = inspect.getfullargspec(f.__call__)
-	finally:
-		if isinstance(f, (Deferred, Lambda)):
-			f.repr_disabled = False
-
-	args = len(spec.args)
-	varargs = spec.varargs is not None
-	kwargs = spec.varkw is not None
-
-	# Method
-	if isinstance(f, types.MethodType):
-		args -= 1 # self
-	elif isinstance(f, types.FunctionType):
-		pass
-
-	if args >= 1 or varargs or kwargs:
-		return f(context)
-	else:
-		return f()
+		while True:
+			# Go down to a leaf
+			while True:
+				if isinstance(node, Deferred):
+					if node.cached:
+						value = node.cache
+						break
+					elif node.is_evaluating:
+						raise OverflowError("Deferred value is recursively defined")
+					node.is_evaluating = True
+					frames.append([node, 0, None])
+					if profile is not None:
+						profile.enter(node)
+					node = node.f
+				elif isinstance(node, Lambda):
+					if node.op is not None:
+						frames.append([node, 0, None])
+						node = node.l
+					elif not callable(node.l):
+						value = node.l
+						break
+					elif node.pass_context:
+						node = node.l
+					else:
+						node = node.l()
+						if not isinstance(node, Deferred):
+							value = node
+							break
+				elif callable(node):
+					node = node(context)
+					if not isinstance(node, Deferred):
+						value = node
+						break
+				else:
+					value = node
+					break
+
+			# Go up until a node needs another operand evaluated
+			while frames:
+				frame = frames[-1]
+				top = frame[0]
+				if isinstance(top, Lambda):
+					if top.r is not None and frame[1] == 0:
+						frame[1] = 1
+						frame[2] = value
+						node = top.r
+						break
+					elif top.r is not None:
+						value = top.op(frame[2], value)
+					else:
+						value = top.op(value)
+					frames.pop()
+					if isinstance(value, Deferred):
+						node = value
+						break
+				else:
+					if frame[1] == 0:
+						# Handle padding math
+						for optext, op, other, reverse in top.pending_math:
+							if reverse:
+								value = op(other, value)
+							else:
+								value = op(value, other)
+						if isinstance(value, Deferred):
+							frame[1] = 1
+							node = value
+							break
+					top.is_evaluating = False
+					top.cached = True
+					top.cache = value
+					frames.pop()
+					if profile is not None:
+						profile.leave()
+			else:
+				return value
+	except:
+		for frame in frames:
+			if isinstance(frame[0], Deferred):
+				frame[0].is_evaluating = False
+		if profile is not None:
+			profile.fail(mark, sys.exc_info()[1])
+		raise
 
 
 class Deferred(object):
-	def __init__(self, f, tp=None):
+	takes_context = True
+
+	# Deferred objects are created for almost every emitted byte
+	__slots__ = ("f", "pending_math", "cached", "cache", "type", "is_evaluating", "isOffset")
+
+	def __init__(self, f, tp=None, takes_context=True):
 		if isinstance(f, Deferred):
 			self.f = f.f
-			self.pending_math = [obj[:] for obj in f.pending_math]
+			self.pending_math = f.pending_math
 			self.cached = f.cached
 			self.cache = f.cache
 			self.type = tp if tp is not None else f.type
 		elif callable(f):
-			self.f = Lambda(f)
-			self.pending_math = []
+			self.f = Lambda(f, takes_context=takes_context)
+			self.pending_math = ()
 			self.cached = False
 			self.cache = None
 			self.type = tp if tp is not None else type(f)
 		else:
 			self.f = Lambda(f)
-			self.pending_math = []
+			self.pending_math = ()
 			self.cached = True
 			self.cache = f
 			self.type = tp if tp is not None else type(f)
 
 		self.is_evaluating = False
-		self.repr_disabled = False
 
 
 	def __call__(self, context=None):
 		if self.cached:
 			return self.cache
-		elif self.is_evaluating:
-			raise OverflowError("Deferred value is recursively defined")
-
-		self.is_evaluating = True
-
-		try:
-			result = self.f(context)
-			# Handle padding math
-			for optext, op, other, reverse in self.pending_math:
-				if reverse:
-					result = op(other, result)
-				else:
-					result = op(result, other)
-
-			while isinstance(result, Deferred):
-				result = result(context)
-		finally:
-			self.is_evaluating = False
-
-		self.cached = True
-		self.cache = result
-		return result
+		return evaluate(self, context)
 
 
 	def map(self, f):
@@ -220,26 +363,93 @@ class Deferred(object):
 				if last_optext == optext and not reverse and not last_reverse:
 					if optext in ("+", ">>", "<<"):
 						# Optimizable by sum
-						self.pending_math[-1][2] += other
+						self.setLastOperand(self.pending_math[-1][2] + other)
+						self.dropIdentity()
 						return
 					elif optext == "*":
 						# Optimizable by multiplication
-						self.pending_math[-1][2] *= other
+						self.setLastOperand(self.pending_math[-1][2] * other)
+						self.dropIdentity()
 						return
 					elif optext == "&":
 						# Optimizable by &
-						self.pending_math[-1][2] &= other
+						self.setLastOperand(self.pending_math[-1][2] & other)
 						return
 					elif optext == "|":
 						# Optimizable by |
-						self.pending_math[-1][2] |= other
+						self.setLastOperand(self.pending_math[-1][2] | other)
+						self.dropIdentity()
 						return
 					elif optext == "^":
 						# Optimizable by ^
-						self.pending_math[-1][2] ^= other
+						self.setLastOperand(self.pending_math[-1][2] ^ other)
+						self.dropIdentity()
 						return
 
-		self.pending_math.append([optext, op, other, reverse])
+			if not reverse and type(other) is int and identities.get(optext) == other:
+				# Nothing to do
+				return
+
+		self.pending_math += ((optext, op, other, reverse),)
+
+	def setLastOperand(self, other):
+		optext, op, _, reverse = self.pending_math[-1]
+		self.pending_math = self.pending_math[:-1] + ((optext, op, other, reverse),)
+
+	def dropIdentity(self):
+		# Remove the last pending operation if merging made it a no-op
+		optext, _, other, _ = self.pending_math[-1]
+		if type(other) is int and identities.get(optext) == other:
+			self.pending_math = self.pending_math[:-1]
+
+	def splitOffset(self):
+		# Split a + n to a and n
+		if (
+			not self.cached and
+			self.pending_math and
+			self.pending_math[-1][0] == "+" and
+			not self.pending_math[-1][3] and
+			type(self.pending_math[-1][2]) is int
+		):
+			res = Deferred(self)
+			_, _, n, _ = res.pending_math[-1]
+			res.pending_math = res.pending_math[:-1]
+			return res, n
+		return self, 0
+
+
+	def isSameBase(self, other):
+		# Returns True if both values are known to be equal, e.g. two labels
+		# that follow the same .BLKB after splitOffset()
+		if self.cached or other.cached or self.f is not other.f:
+			return False
+		elif len(self.pending_math) != len(other.pending_math):
+			return False
+		for (optext1, _, other1, reverse1), (optext2, _, other2, reverse2) in zip(self.pending_math, other.pending_math):
+			if optext1 != optext2 or reverse1 != reverse2:
+				return False
+			elif other1 is not other2 and not (type(other1) is int and type(other2) is int and other1 == other2):
+				return False
+		return True
+
+	def substitute(self, f):
+		# Rebuild the value with leaves of the tree (e.g. Expression.Get)
+		# replaced by f(leaf), so that arithmetic is folded again, e.g. a
+		# label minus . becomes an int if both are in the same place. f
+		# returns None to keep the leaf. Returns self if nothing changed.
+		if self.cached:
+			return self
+
+		value = self.f.substitute(f)
+		if value is None:
+			return self
+
+		for optext, op, other, reverse in self.pending_math:
+			if reverse:
+				value = op(other, value)
+			else:
+				value = op(value, other)
+		return value
 
 
 	def isA(self, type):
@@ -286,9 +496,6 @@ class Deferred(object):
 	__invert__ = prefix("~", operator.invert)
 
 	def __repr__(self):
-		if self.repr_disabled:
-			return "<Deferred>"
-
 		rpr = repr(self.f)
 		for optext, _, other, reverse in self.pending_math:
 			if reverse:
@@ -316,7 +523,7 @@ class Deferred(object):
 		if self.cached:
 			return Deferred(f(self.cache), tp)
 		else:
-			return Deferred(Lambda(self, "({name})".format(name=f.__name__), lambda value: f(value)), tp)
+			return Deferred(Lambda(self, "({name})".format(name=f.__name__), f), tp)
 
 
 
@@ -359,6 +566,9 @@ class Deferred(object):
 		count = cls(count)
 		what = cls(what)
 
+		if count.cached and what.cached:
+			return cls([what.cache] * count.cache, list)
+
 		def f(context):
 			what1 = what(context)
 
@@ -374,7 +584,7 @@ class Deferred(object):
 		err = cls(err)
 		def cb():
 			raise err()
-		return cls(Lambda(cb, lambda: "raise {err!r}".format(err=err)), Deferred.Raise)
+		return cls(Lambda(cb, lambda: "raise {err!r}".format(err=err), takes_context=False), Deferred.Raise)
 
 
 	@classmethod
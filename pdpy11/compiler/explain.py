@@ -0,0 +1,376 @@
+from __future__ import print_function
+import json
+import time
+from . import deferred
+from .deferred import Deferred, Lambda
+from .expression import Expression
+from .util import octal, Fill
+
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+def valueKey(value):
+	# Deferred(x) copies x, and link() evaluates such copies. A copy shares
+	# f and pending_math with the original, so that's what identifies a value.
+	return id(value.f), id(value.pending_math)
+
+
+class Explainer(object):
+	# Collects the dependency graph of labels and writes, and how long each
+	# Deferred value took to evaluate (see --explain-deferred).
+	#
+	# While installed, deferred.evaluate() reports every Deferred it
+	# evaluates: enter() and leave() measure the time with and without the
+	# values it depends on, fail() remembers which values were being
+	# evaluated when an error happened.
+
+	def __init__(self):
+		self.stack = []
+		self.stats = {}
+		self.failure = None
+		self.failure_exc = None
+		self.labels = None
+		self.writes = None
+
+	def install(self):
+		deferred.profiler = self
+
+	def uninstall(self):
+		deferred.profiler = None
+
+
+	def enter(self, node):
+		# [node, start time, time spent in dependencies]
+		self.stack.append([node, timer(), 0])
+
+	def leave(self):
+		node, start, inner = self.stack.pop()
+		total = timer() - start
+		if self.stack:
+			self.stack[-1][2] += total
+
+		key = valueKey(node)
+		stats = self.stats.get(key)
+		if stats is None:
+			# The node is kept alive so that the ids in the key are not reused
+			stats = self.stats[key] = [node, 0, 0, 0]
+		stats[1] += 1
+		stats[2] += total
+		stats[3] += total - inner
+
+	def fail(self, mark, exc):
+		# Called by every evaluate() the exception passes through, the
+		# innermost one sees the whole stack
+		if exc is not self.failure_exc:
+			self.failure_exc = exc
+			self.failure = [frame[0] for frame in self.stack]
+		del self.stack[mark:]
+
+
+	def snapshot(self, compiler):
+		# Must be called before link() replaces labels with their values
+		self.compiler = compiler
+		self.labels = dict(compiler.labels)
+		if compiler.project is not None:
+			self.writes = [write for _, _, _, writes, _ in compiler.all_build for write in writes]
+		else:
+			self.writes = list(compiler.writes)
+
+
+	def getLabelName(self, get):
+		if get.key is not None:
+			return get.key
+		elif isinstance(get.s, int):
+			return None
+		elif get.s in self.labels:
+			return get.s
+		local_s = "{file_id}:{s}".format(file_id=get.file_id, s=get.s)
+		if local_s in self.labels:
+			return local_s
+		return None
+
+	def describe(self, value):
+		# A short description, repr() of a Deferred may be as long as the
+		# program
+		if isinstance(value, int):
+			return octal(value)
+		elif isinstance(value, Deferred):
+			text = self.describe(value.f)
+			for optext, _, other, reverse in value.pending_math:
+				other = self.describe(other) if isinstance(other, int) else "..."
+				if reverse:
+					text = "({other} {op} {text})".format(other=other, op=optext, text=text)
+				else:
+					text = "({text} {op} {other})".format(other=other, op=optext, text=text)
+			return text if len(text) <= 80 else text[:77] + "..."
+		elif isinstance(value, Lambda):
+			if value.op is not None:
+				return "({op} ...)".format(op=value.getOpText())
+			return self.describe(value.l)
+		elif isinstance(value, Expression.Get):
+			return value.deferredRepr() if not isinstance(value.s, int) else octal(value.s)
+		elif hasattr(value, "deferredRepr"):
+			return value.deferredRepr()
+		elif callable(value):
+			return "{name}()".format(name=getattr(value, "__name__", "?"))
+		else:
+			return "..."
+
+
+	def build(self, linked):
+		# Builds self.nodes, a list of dicts, and self.edges, a list of lists
+		# of node indices. If linking succeeded, addresses are shown as
+		# numbers.
+		self.nodes = []
+		self.edges = []
+		owner = {}
+		pending = []
+
+		def addNode(node, value):
+			i = len(self.nodes)
+			node["evaluations"] = 0
+			node["time"] = 0
+			node["self_time"] = 0
+			self.nodes.append(node)
+			self.edges.append([])
+			if isinstance(value, Deferred):
+				key = valueKey(value)
+				if key in owner:
+					# Another label or write with the same value
+					self.edges[i].append(owner[key])
+				else:
+					owner[key] = i
+					pending.append((i, value))
+			return i
+
+		label_ids = {}
+		for name in sorted(self.labels):
+			value = self.labels[name]
+			label_ids[name] = addNode({
+				"id": "label:" + name,
+				"kind": "label",
+				"name": name,
+				"expr": self.describe(value)
+			}, value)
+		for n, (addr, value) in enumerate(self.writes):
+			if isinstance(value, Fill):
+				# Zero bytes, only the length is computed
+				value = value.length
+			if isinstance(addr, Deferred) and linked:
+				address = octal(Deferred(addr, int)(self.compiler))
+			else:
+				address = self.describe(addr)
+			i = addNode({
+				"id": "write:{n}".format(n=n),
+				"kind": "write",
+				"name": "write at " + address,
+				"expr": self.describe(value)
+			}, value)
+			if isinstance(addr, Deferred):
+				pending.append((i, addr))
+
+		while pending:
+			i, value = pending.pop()
+			for dep in deferred.dependencies(value):
+				if isinstance(dep, Expression.Get):
+					j = label_ids.get(self.getLabelName(dep))
+					if j is None:
+						continue
+				elif isinstance(dep, Deferred):
+					j = owner.get(valueKey(dep))
+					if j is None:
+						j = addNode({
+							"id": "v{n}".format(n=len(self.nodes)),
+							"kind": "value",
+							"name": self.describe(dep),
+							"expr": self.describe(dep)
+						}, dep)
+				else:
+					continue
+				if j != i and j not in self.edges[i]:
+					self.edges[i].append(j)
+
+		for key, (_, evaluations, total, self_time) in self.stats.items():
+			i = owner.get(key)
+			if i is not None:
+				self.nodes[i]["evaluations"] += evaluations
+				self.nodes[i]["time"] += total
+				self.nodes[i]["self_time"] += self_time
+
+		self.failing_chain = []
+		for node in self.failure or []:
+			i = owner.get(valueKey(node))
+			if i is not None and i not in self.failing_chain:
+				self.failing_chain.append(i)
+
+		self.computeDepth()
+
+
+	def computeDepth(self):
+		# Depth is the length of the longest dependency chain below a node.
+		# Depth-first search without recursion, because chains are as long
+		# as the program.
+		depth = [None] * len(self.nodes)
+		self.next = [None] * len(self.nodes)
+		self.cycles = []
+		on_stack = [False] * len(self.nodes)
+
+		for root in range(len(self.nodes)):
+			if depth[root] is not None:
+				continue
+			stack = [(root, 0)]
+			on_stack[root] = True
+			while stack:
+				i, k = stack[-1]
+				if k < len(self.edges[i]):
+					stack[-1] = (i, k + 1)
+					j = self.edges[i][k]
+					if on_stack[j]:
+						path = [frame[0] for frame in stack]
+						self.cycles.append(path[path.index(j):] + [j])
+					elif depth[j] is None:
+						on_stack[j] = True
+						stack.append((j, 0))
+				else:
+					stack.pop()
+					on_stack[i] = False
+					depth[i] = 0
+					for j in self.edges[i]:
+						if depth[j] is not None and depth[j] + 1 > depth[i]:
+							depth[i] = depth[j] + 1
+							self.next[i] = j
+
+		for i, node in enumerate(self.nodes):
+			node["depth"] = depth[i]
+
+	def getChain(self, i):
+		chain = [i]
+		while self.next[i] is not None:
+			i = self.next[i]
+			chain.append(i)
+		return chain
+
+	def formatChain(self, chain):
+		# Anonymous values are only counted, labels name the chain
+		parts = []
+		skipped = 0
+		for n, i in enumerate(chain):
+			if self.nodes[i]["kind"] == "value" and 0 < n < len(chain) - 1:
+				skipped += 1
+				continue
+			if skipped:
+				parts.append("({n} value{s})".format(n=skipped, s="" if skipped == 1 else "s"))
+				skipped = 0
+			parts.append(self.nodes[i]["name"])
+		if len(parts) > 9:
+			parts = parts[:4] + ["({n} more)".format(n=len(parts) - 8)] + parts[-4:]
+		return " -> ".join(parts)
+
+
+	def getExpensive(self, count=10):
+		order = sorted(range(len(self.nodes)), key=lambda i: -self.nodes[i]["self_time"])
+		return [i for i in order[:count] if self.nodes[i]["evaluations"] > 0]
+
+	def getDeepest(self, count=10):
+		# Only labels and writes start a chain, and a chain that continues
+		# one already listed is skipped, otherwise a long chain would show up
+		# once per label or write in it
+		roots = [i for i, node in enumerate(self.nodes) if node["kind"] != "value" and node["depth"] > 0]
+		roots.sort(key=lambda i: -self.nodes[i]["depth"])
+		chains = []
+		seen = set()
+		for i in roots:
+			if len(chains) == count:
+				break
+			elif i in seen or self.next[i] in seen:
+				continue
+			chain = self.getChain(i)
+			chains.append(chain)
+			seen.update(chain)
+		return chains
+
+
+	def write(self, path, format="json"):
+		if format == "dot":
+			self.writeDot(path)
+		else:
+			self.writeJson(path)
+
+	def writeJson(self, path):
+		nodes = []
+		for i, node in enumerate(self.nodes):
+			node = dict(node)
+			node["deps"] = [self.nodes[j]["id"] for j in self.edges[i]]
+			nodes.append(node)
+
+		with open(path, "w") as f:
+			json.dump({
+				"nodes": nodes,
+				"expensive": [self.nodes[i]["id"] for i in self.getExpensive()],
+				"deepest": [[self.nodes[i]["id"] for i in chain] for chain in self.getDeepest()],
+				"failure": [self.nodes[i]["id"] for i in self.failing_chain],
+				"cycles": [[self.nodes[i]["id"] for i in cycle] for cycle in self.cycles]
+			}, f, indent=1)
+
+	def writeDot(self, path):
+		def quote(s):
+			return "\"" + s.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+
+		failing = set(self.failing_chain)
+		with open(path, "w") as f:
+			f.write("digraph deferred {\n")
+			for i, node in enumerate(self.nodes):
+				label = "{name}\\n{evaluations} eval, {time:.6f} s, depth {depth}".format(
+					name=node["name"].replace("\\", "\\\\").replace("\"", "\\\""),
+					evaluations=node["evaluations"],
+					time=node["time"],
+					depth=node["depth"]
+				)
+				attrs = "label=\"{label}\"".format(label=label)
+				if node["kind"] == "value":
+					attrs += ", shape=ellipse"
+				else:
+					attrs += ", shape=box"
+				if i in failing:
+					attrs += ", color=red"
+				f.write("\t{id} [{attrs}];\n".format(id=quote(node["id"]), attrs=attrs))
+			for i, deps in enumerate(self.edges):
+				for j in deps:
+					f.write("\t{a} -> {b};\n".format(a=quote(self.nodes[i]["id"]), b=quote(self.nodes[j]["id"])))
+			f.write("}\n")
+
+
+	def printSummary(self):
+		total = sum(node["self_time"] for node in self.nodes)
+		evaluations = sum(node["evaluations"] for node in self.nodes)
+		print("Deferred values: {nodes} nodes, {evaluations} evaluations, {total:.6f} s".format(
+			nodes=len(self.nodes),
+			evaluations=evaluations,
+			total=total
+		))
+
+		expensive = self.getExpensive()
+		if expensive:
+			print()
+			print("Most expensive (self time, total time, evaluations):")
+			for i in expensive:
+				node = self.nodes[i]
+				print("  {self_time:.6f} s  {time:.6f} s  {evaluations:>6}  {name}".format(**node))
+
+		deepest = self.getDeepest()
+		if deepest:
+			print()
+			print("Deepest chains:")
+			for chain in deepest:
+				print("  {depth:>6}  {chain}".format(depth=len(chain) - 1, chain=self.formatChain(chain)))
+
+		if self.failing_chain:
+			print()
+			print("Failed while evaluating:")
+			print("  " + self.formatChain(self.failing_chain))
+
+		for cycle in self.cycles:
+			print()
+			print("Cycle:")
+			print("  " + self.formatChain(cycle))
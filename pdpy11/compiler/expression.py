@@ -3,39 +3,60 @@ from .util import octal, raiseExpressionEvaluateError
 
 
 class Expression(object):
-	def __new__(cls, s, file_id, line, column):
+	def __new__(cls, s, file_id, coords):
 		if isinstance(s, int):
 			return s
 		else:
-			return Deferred(cls.Get(s, file_id, line, column), int)
+			return Deferred(cls.Get(s, file_id, coords), int)
 
 	class Get(object):
-		def __init__(self, s, file_id, line, column):
+		takes_context = True
+
+		__slots__ = ("s", "file_id", "coords", "local_s", "key")
+
+		def __init__(self, s, file_id, coords):
 			self.s = s
 			self.file_id = file_id
-			self.line = line
-			self.column = column
+			self.coords = coords
+			self.local_s = None
+			# The name the label is defined with, see lookup()
+			self.key = None
+
+		def __reduce__(self):
+			# The key depends on the labels of the current build
+			return Expression.Get, (self.s, self.file_id, self.coords)
 
 		def __call__(self, compiler):
-			if isinstance(self.s, int):
+			value = self.lookup(compiler.labels)
+			if value is not None:
+				return value
+
+			raiseExpressionEvaluateError(
+				self.file_id,
+				self.coords["line"],
+				self.coords["column"],
+				"Label '{s}' not found".format(s=self.s)
+			)
+
+		def lookup(self, labels):
+			# Returns None if the label is not defined (yet). Once the label
+			# is found, its name is kept: a global label can't be defined
+			# later if a local one with the same name exists (see
+			# Compiler.defineLabel), so the name never changes.
+			if self.key is not None:
+				return labels[self.key]
+			elif isinstance(self.s, int):
 				return self.s
+			elif self.s in labels:
+				self.key = self.s
+				return labels[self.key]
 
-			def label():
-				try:
-					return compiler.labels[self.s]
-				except KeyError:
-					try:
-						global_s = "{file_id}:{s}".format(file_id=self.file_id, s=self.s)
-						return compiler.labels[global_s]
-					except KeyError:
-						raiseExpressionEvaluateError(
-							self.file_id,
-							self.line,
-							self.column,
-							"Label '{s}' not found".format(s=self.s)
-						)
-
-			return Deferred(label, int)
+			if self.local_s is None:
+				self.local_s = "{file_id}:{s}".format(file_id=self.file_id, s=self.s)
+			if self.local_s in labels:
+				self.key = self.local_s
+				return labels[self.key]
+			return None
 
 		def deferredRepr(self):
 			if self.s[0] in "0123456789":
@@ -46,12 +67,12 @@ class Expression(object):
 		def map(self, f):
 			if isinstance(self.s, int):
 				return self
-			return Expression.Get(f(self.s), self.file_id, self.line, self.column)
+			return Expression.Get(f(self.s), self.file_id, self.coords)
 
 	@staticmethod
 	def asOffset(expr):
 		if isinstance(expr, int):
-			expr = Deferred(Expression.Get(expr, "???", 0, 0), int)
+			expr = Deferred(Expression.Get(expr, "???", {"line": 0, "column": 0}), int)
 
 		expr.isOffset = True
 		return expr
@@ -62,6 +83,10 @@ class StaticAlloc(object):
 		return Deferred(cls.Get(length, is_byte), int)
 
 	class Get(object):
+		takes_context = True
+
+		__slots__ = ("length", "byte_length", "is_byte", "cache")
+
 		def __init__(self, length, is_byte):
 			self.length = length
 			if is_byte:
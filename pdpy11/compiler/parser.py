@@ -5,11 +5,13 @@ from .commands import commands
 from .deferred import Deferred
 from .expression import Expression, StaticAlloc
 import operator
-from .util import raiseSyntaxError, encodeKoi8, A, R, D, I, PC
+import re
+from .util import raiseSyntaxError, encodeKoi8, LineIndex, Coords, A, R, D, I, PC
 
 
 whitespace = "\n\r\t "
 punctuation = ",!@#%^&*()[]\\{}|/~`'\";:?<>.+-="
+delimiters = frozenset(whitespace + punctuation)
 registers = ("R0", "R1", "R2", "R3", "R4", "R5", "R6", "R7", "SP", "PC")
 
 operators = {}
@@ -25,46 +27,313 @@ for priority, (assoc, ops) in enumerate((
 		operators[char] = (priority, assoc, op)
 
 
+# Token regexes. They are matched at the current position only: the same
+# character may start different tokens depending on context (e.g. "/" is both
+# a string delimiter and an operator), so the source is not split in advance.
+skip_re = re.compile(r"(?:[\n\r\t ]+|;[^\n]*|//[^\n]*)*")
+literal_re = re.compile(r"[A-Za-z_$][A-Za-z0-9_$]*")
+integer_label_re = re.compile(r"[0-9][A-Za-z0-9_$]*")
+simple_integer_re = re.compile(r"[+-]?[0-9]+(\.)?")
+word_re = re.compile(r"[^{delimiters}]*".format(delimiters=re.escape(whitespace + punctuation)))
+raw_re = re.compile(r"[^\r\n]*")
+operator_re = re.compile("|".join(
+	re.escape(char) for char in sorted(operators.keys(), key=len, reverse=True)
+))
+radix_prefixes = {"B": 2, "O": 8, "X": 16}
+
+
+# Directives that can be used without a dot, e.g. "ORG" or "make_raw"
+bare_directives = {
+	"ORG":                lambda parser: parser.handleLink(),
+	"DB":                 lambda parser: parser.handleByte(),
+	"DW":                 lambda parser: parser.handleWord(),
+	"DS":                 lambda parser: parser.handleBlkb(),
+	"ALIGN":              lambda parser: parser.handleAlign(),
+	"MAKE_RAW":           lambda parser: parser.handleMakeRaw(),
+	"MAKE_BK0010_ROM":    lambda parser: parser.handleMakeBin(),
+	"MAKE_BIN":           lambda parser: parser.handleMakeBin(),
+	"MAKE_SAV":           lambda parser: parser.handleMakeSav(),
+	"MAKE_TURBO_WAV":     lambda parser: parser.handleMakeTurboWav(),
+	"MAKE_WAV":           lambda parser: parser.handleMakeWav(),
+	"CONVERT1251TOKOI8R": lambda parser: parser.handleConvert1251toKOI8R(),
+	"DECIMALNUMBERS":     lambda parser: parser.handleDecimalNumbers(),
+	"INSERT_FILE":        lambda parser: parser.handleInsertFile()
+}
+
+# Directives that start with a dot, e.g. ".LINK"
+dot_directives = {
+	"LINK":               lambda parser: parser.handleLink(),
+	"LA":                 lambda parser: parser.handleLink(),
+	"INCLUDE":            lambda parser: parser.handleInclude(),
+	"RAW_INCLUDE":        lambda parser: parser.handleInclude(raw=True),
+	"PDP11":              lambda parser: parser.handlePdp11(),
+	"I8080":              lambda parser: parser.handleI8080(),
+	"SYNTAX":             lambda parser: parser.handleSyntax(),
+	"DB":                 lambda parser: parser.handleByte(),
+	"BYTE":               lambda parser: parser.handleByte(),
+	"DW":                 lambda parser: parser.handleWord(),
+	"WORD":               lambda parser: parser.handleWord(),
+	"DWORD":              lambda parser: parser.handleDword(),
+	"DS":                 lambda parser: parser.handleBlkb(),
+	"BLKB":               lambda parser: parser.handleBlkb(),
+	"BLKW":               lambda parser: parser.handleBlkw(),
+	"EVEN":               lambda parser: parser.handleEven(),
+	"ASCII":              lambda parser: parser.handleAscii(term=""),
+	"ASCIZ":              lambda parser: parser.handleAscii(term="\x00"),
+	"REPEAT":             lambda parser: parser.handleRepeat(),
+	"EXTERN":             lambda parser: parser.handleExtern(),
+	"ONCE":               lambda parser: parser.handleOnce()
+}
+
+# Used by scanDirectives()
+scan_label_re = re.compile(r"[\t ]*([A-Za-z_$][A-Za-z0-9_$]*|[0-9][A-Za-z0-9_$]*)[\t ]*:")
+scan_close_re = re.compile(r"[\t ]*}")
+scan_directive_re = re.compile(r"[\t ]*(\.?)[\t ]*([A-Za-z_$][A-Za-z0-9_$]*)")
+scan_brackets_re = re.compile(r"\"[^\"]*\"|'[^']*'|;.*|//.*|[{}]")
+scan_comma_re = re.compile(r"[\t ]*,")
+# Directives whose arguments are read by Parser.needString()
+string_directives = (
+	"ASCII", "ASCIZ", "INCLUDE", "INSERT_FILE", "MAKE_RAW", "MAKE_BK0010_ROM",
+	"MAKE_BIN", "MAKE_SAV", "MAKE_TURBO_WAV", "MAKE_WAV"
+)
+
+def scanString(code, pos):
+	# Skips strings like Parser.needString() reads them: the first character
+	# is the delimiter, so e.g. { or ; inside /.../ is a part of the string,
+	# and a string may span lines. Returns the position after the last one.
+	end = pos
+	while True:
+		pos = skip_re.match(code, pos).end()
+		if code.startswith("<", pos):
+			close = code.find(">", pos)
+		elif code[pos:pos + 1] in ("\"", "'", "/"):
+			close = code.find(code[pos], pos + 1)
+		else:
+			return end
+		if close == -1:
+			return len(code)
+		pos = close + 1
+		end = pos
+
+def scanDirectives(code, syntax):
+	# A lightweight alternative to Parser.parse() for finding out which
+	# directives a file uses (e.g. make_raw), without parsing it. Only the
+	# command at the start of each line is read. Like parse(), this skips
+	# commands inside .REPEAT blocks and stops at .END. Yields directive
+	# names, with a dot prefix if the directive was used with a dot.
+
+	depth = 0
+	pos = 0
+	while pos <= len(code):
+		eol = code.find("\n", pos)
+		if eol == -1:
+			eol = len(code)
+
+		# End of .REPEAT block
+		match = scan_close_re.match(code, pos, eol)
+		while match is not None:
+			depth = max(depth - 1, 0)
+			pos = match.end()
+			match = scan_close_re.match(code, pos, eol)
+
+		# Labels
+		match = scan_label_re.match(code, pos, eol)
+		while match is not None and match.group(1).upper() != "END" and match.group(1).upper() not in bare_directives:
+			pos = match.end()
+			match = scan_label_re.match(code, pos, eol)
+
+		match = scan_directive_re.match(code, pos, eol)
+		if match is not None:
+			pos = match.end()
+			dot, literal = match.group(1), match.group(2).upper()
+			if literal == "END":
+				return
+			elif dot and literal in dot_directives:
+				if depth == 0:
+					yield "." + literal
+				if literal == "SYNTAX":
+					match = scan_directive_re.match(code, pos, eol)
+					if match is not None:
+						syntax = match.group(2).lower()
+				elif literal == "INCLUDE" and syntax == "pdp11asm":
+					return
+			elif not dot and literal in bare_directives and depth == 0:
+				yield literal
+
+			if (dot or literal in bare_directives) and literal in string_directives:
+				# Arguments, separated by commas
+				pos = scanString(code, pos)
+				match = scan_comma_re.match(code, pos)
+				while match is not None:
+					pos = scanString(code, match.end())
+					match = scan_comma_re.match(code, pos)
+				if pos > eol:
+					# The string went on to the next lines
+					eol = code.find("\n", pos)
+					if eol == -1:
+						eol = len(code)
+
+		# Start and end of .REPEAT blocks
+		for match in scan_brackets_re.finditer(code, pos, eol):
+			if match.group() == "{":
+				depth += 1
+			elif match.group() == "}":
+				depth = max(depth - 1, 0)
+
+		pos = eol + 1
+
+
+class Mark(str):
+	# Name of a label created for . (dot). Marks are numbered globally, so
+	# a saved command stream renumbers them when it is loaded (see
+	# cache.StreamUnpickler).
+	def __reduce__(self):
+		return Mark, (str(self),)
+
+
 class EndOfParsingError(Exception):
 	pass
 class InvalidError(Exception):
-	pass
+	def __init__(self, message, pos=None):
+		super(InvalidError, self).__init__(message)
+		# Both are only filled in while diagnosing, see Parser.diagnose()
+		self.pos = pos
+		self.stages = []
+
+
+def stage(name):
+	# Marks a directive/command handler as a parsing stage, so that it is
+	# mentioned in syntax error reports
+	def decorator(f):
+		def handler(self, *args, **kwargs):
+			pos = self.pos
+			try:
+				return f(self, *args, **kwargs)
+			except InvalidError as e:
+				self.backtrack(e, pos, False, name)
+		handler.__name__ = f.__name__
+		return handler
+	return decorator
+
+
+def memoized(rule):
+	# Packrat memoization: remembers the outcome of a rule at a position, so
+	# that after a rollback the same sub-parse is not repeated. The result
+	# depends on last_label, decimal and syntax, which may only change
+	# between commands, so the memo table is reset for every command.
+	def decorator(f):
+		def handler(self, maybe=False, **kwargs):
+			if self.memo is None or self.diagnosing:
+				return f(self, maybe=maybe, **kwargs)
+
+			pos = self.pos
+			key = (rule, pos, tuple(kwargs.items()))
+			if key in self.memo:
+				self.memo_hits += 1
+				result, end, error = self.memo[key]
+				if error is None:
+					self.pos = end
+					return result
+				elif maybe:
+					return None
+				raise error
+
+			self.memo_misses += 1
+			try:
+				result = f(self, maybe=False, **kwargs)
+			except InvalidError as e:
+				self.memo[key] = (None, pos, e)
+				if maybe:
+					self.pos = pos
+					return None
+				raise
+			self.memo[key] = (result, self.pos, None)
+			return result
+		handler.__name__ = f.__name__
+		return handler
+	return decorator
+
+
+def isIntegerLike(local_label):
+	# Raw integers (e.g. 123), as well as 0x..., 0b... and 0o... labels, are
+	# most likely meant to be integers
+	lower = local_label.lower()
+	return (
+		local_label.isdigit() or
+		lower.startswith("0x") or
+		lower.startswith("0b") or
+		lower.startswith("0o")
+	)
+
 
 class Parser(object):
 	last_mark = 0
 
-	def __init__(self, file, code, syntax):
+	def __init__(self, file, code, syntax, memoize=False):
 		self.code = code
+		self.lines = LineIndex(code)
 		self.pos = 0
 		self.cmd_start = 0
 		self.file = file
 		self.decimal = False
 		self.syntax = syntax
 		self.last_label = ""
-		self.stage_stack = []
-		self.last_error_stages = []
+		self.diagnosing = False
+		self.memo = {} if memoize else None
+		# How many sub-parses were answered from / stored to the memo table
+		self.memo_hits = 0
+		self.memo_misses = 0
 
 	def parse(self):
 		try:
 			while True:
+				state = (self.pos, self.decimal, self.syntax, self.last_label)
 				for cmd in self.parseCommand():
 					yield cmd
 		except EndOfParsingError:
 			pass
 		except InvalidError as e:
+			e = self.diagnose(state, e)
+
 			# Position to line/col
-			line = len(self.code[:self.pos].split("\n"))
-			try:
-				last_lf = self.code[:self.pos].rindex("\n")
-			except ValueError:
-				last_lf = 0
-			col = self.pos - last_lf
+			line, col = self.lines.locate(e.pos)
+			raiseSyntaxError(self.file, line=line, column=col, stack=e.stages[::-1], error=e)
+
+	def diagnose(self, state, error):
+		# Parsing doesn't track where it is, so that backtracking only costs
+		# saving and restoring self.pos. When a syntax error is actually
+		# reported, the failing command is parsed once again, this time
+		# collecting the stages and the position of the innermost failing
+		# rule.
+		self.pos, self.decimal, self.syntax, self.last_label = state
+		self.diagnosing = True
+		try:
+			for _ in self.parseCommand():
+				pass
+		except InvalidError as e:
+			return e
+		except EndOfParsingError:
+			pass
+		finally:
+			self.diagnosing = False
+
+		# Should never happen
+		error.pos = self.pos
+		return error
 
-			stack = []
-			for stage in self.last_error_stages:
-				if stage is not None:
-					stack.append(stage)
-			raiseSyntaxError(self.file, line=line, column=col, stack=stack, error=e)
+	def backtrack(self, error, pos, maybe, stage=None, **stage_args):
+		# Called when a rule that started at pos fails with error. If the
+		# rule is optional, rollback and return None, otherwise reraise.
+		if maybe:
+			self.pos = pos
+			return None
+
+		if self.diagnosing:
+			if error.pos is None:
+				error.pos = pos
+			if stage is not None:
+				error.stages.append(stage.format(**stage_args) if stage_args else stage)
+		raise error
 
 	def parseCommand(self, labels=None):
 		if labels is None:
@@ -78,118 +347,40 @@ class Parser(object):
 
 		self.skipWhitespace()
 		self.cmd_start = self.pos
+		if self.memo:
+			self.memo.clear()
 
-		with Transaction(self, maybe=False, stage="command") as t:
-			pos = self.pos
+		pos = self.pos
+		command_stage = "command"
+		try:
 			literal = self.needLiteral(maybe=True)
 
 			# First, handle metacommands (directives)
-			if literal == "ORG":
-				yield self.handleLink(), labels
-				return
-			elif literal == "DB":
-				yield self.handleByte(), labels
-				return
-			elif literal == "DW":
-				yield self.handleWord(), labels
-				return
-			elif literal == "END":
+			if literal == "END":
 				yield (None, None), labels
 				raise EndOfParsingError()
-			elif literal == "DS":
-				yield self.handleBlkb(), labels
-				return
-			elif literal == "ALIGN":
-				yield self.handleAlign(), labels
-				return
-			elif literal == "MAKE_RAW":
-				yield self.handleMakeRaw(), labels
-				return
-			elif literal in ("MAKE_BK0010_ROM", "MAKE_BIN"):
-				yield self.handleMakeBin(), labels
-				return
-			elif literal == "MAKE_SAV":
-				yield self.handleMakeSav(), labels
-				return
-			elif literal == "MAKE_TURBO_WAV":
-				yield self.handleMakeTurboWav(), labels
-				return
-			elif literal == "MAKE_WAV":
-				yield self.handleMakeWav(), labels
-				return
-			elif literal == "CONVERT1251TOKOI8R":
-				yield self.handleConvert1251toKOI8R(), labels
-				return
-			elif literal == "DECIMALNUMBERS":
-				yield self.handleDecimalNumbers(), labels
-				return
-			elif literal == "INSERT_FILE":
-				yield self.handleInsertFile(), labels
+			elif literal in bare_directives:
+				yield bare_directives[literal](self), labels
 				return
 
 			# Maybe it's a metacommand that starts with a dot?
 			if literal is None and self.needPunct(".", maybe=True):
-				with Transaction(self, maybe=False, stage=".COMMAND") as t:
+				dot_pos = self.pos
+				try:
 					literal = self.needLiteral()
 
-					if literal == "LINK" or literal == "LA":
-						yield self.handleLink(), labels
-						return
-					elif literal == "INCLUDE":
-						yield self.handleInclude(), labels
-						if self.syntax == "pdp11asm":
-							raise EndOfParsingError()
-						return
-					elif literal == "RAW_INCLUDE":
-						yield self.handleInclude(raw=True), labels
-						return
-					elif literal == "PDP11":
-						yield self.handlePdp11(), labels
-						return
-					elif literal == "I8080":
-						yield self.handleI8080(), labels
-						return
-					elif literal == "SYNTAX":
-						yield self.handleSyntax(), labels
-						return
-					elif literal == "DB" or literal == "BYTE":
-						yield self.handleByte(), labels
-						return
-					elif literal == "DW" or literal == "WORD":
-						yield self.handleWord(), labels
-						return
-					elif literal == "DWORD":
-						yield self.handleDword(), labels
-						return
-					elif literal == "END":
+					if literal == "END":
 						yield (None, None), labels
 						raise EndOfParsingError()
-					elif literal == "DS" or literal == "BLKB":
-						yield self.handleBlkb(), labels
-						return
-					elif literal == "BLKW":
-						yield self.handleBlkw(), labels
-						return
-					elif literal == "EVEN":
-						yield self.handleEven(), labels
-						return
-					elif literal == "ASCII":
-						yield self.handleAscii(term=""), labels
-						return
-					elif literal == "ASCIZ":
-						yield self.handleAscii(term="\x00"), labels
-						return
-					elif literal == "REPEAT":
-						yield self.handleRepeat(), labels
-						return
-					elif literal == "EXTERN":
-						yield self.handleExtern(), labels
-						return
-					elif literal == "ONCE":
-						yield self.handleOnce(), labels
+					elif literal in dot_directives:
+						yield dot_directives[literal](self), labels
+						if literal == "INCLUDE" and self.syntax == "pdp11asm":
+							raise EndOfParsingError()
 						return
 					else:
 						raise InvalidError("Expected .COMMAND, got '.{command}'".format(command=literal))
+				except InvalidError as e:
+					self.backtrack(e, dot_pos, False, ".COMMAND")
 
 			if literal is None:
 				# Maybe integer label?
@@ -198,7 +389,7 @@ class Parser(object):
 
 				# It's a label
 				label = "{last_label}: {label}".format(last_label=self.last_label, label=label)
-				t.exit()
+				command_stage = None
 				for cmd in self.parseCommand(labels=labels + [label]):
 					yield cmd
 				return
@@ -208,7 +399,7 @@ class Parser(object):
 			if self.needPunct(":", maybe=True):
 				# It's a label
 				self.last_label = literal
-				t.exit()
+				command_stage = None
 				for cmd in self.parseCommand(labels=labels + [literal]):
 					yield cmd
 				return
@@ -218,42 +409,41 @@ class Parser(object):
 				yield (".EQU", (literal, expr)), labels
 				return
 
-			with Transaction(self, maybe=True) as t:
-				if self.needLiteral() == "EQU":
-					t.noRollback()
-
-					with Transaction(self, maybe=False, stage="EQU") as t:
-						expr = self.needExpression()
-						yield (".EQU", (literal, expr)), labels
-						return
-				else:
-					raise InvalidError("Rollback")
+			if self.needLiteral(maybe=True) == "EQU":
+				equ_pos = self.pos
+				try:
+					expr = self.needExpression()
+				except InvalidError as e:
+					self.backtrack(e, equ_pos, False, "EQU")
+				yield (".EQU", (literal, expr)), labels
+				return
 
 			# It's a command
 			self.pos = pos
 			yield self.handleCommand(), labels
+		except InvalidError as e:
+			self.backtrack(e, pos, False, command_stage)
 
 	def mark(self):
-		label = ".{last_mark}".format(last_mark=Parser.last_mark)
+		label = Mark(".{last_mark}".format(last_mark=Parser.last_mark))
 		self.current_labels.append(label)
 		Parser.last_mark += 1
-		coords = self.getCurrentCommandCoords()
-		return Expression(label, coords["file"], line=coords["line"], column=coords["column"])
+		return Expression(label, self.file, self.getCurrentCommandCoords())
 
 
 
+	@stage(".LINK")
 	def handleLink(self):
 		# ORG / .LINK / .LA
-		with Transaction(self, maybe=False, stage=".LINK"):
-			return ".LINK", self.needExpression()
+		return ".LINK", self.needExpression()
 
+	@stage(".INCLUDE")
 	def handleInclude(self, raw=False):
 		# .INCLUDE / .RAW_INCLUDE
-		with Transaction(self, maybe=False, stage=".INCLUDE"):
-			if raw:
-				return ".INCLUDE", self.needRaw()
-			else:
-				return ".INCLUDE", self.needString()
+		if raw:
+			return ".INCLUDE", self.needRaw()
+		else:
+			return ".INCLUDE", self.needString()
 
 	def handlePdp11(self):
 		return ".PDP11", None
@@ -261,174 +451,177 @@ class Parser(object):
 	def handleI8080(self):
 		return ".I8080", None
 
+	@stage(".SYNTAX")
 	def handleSyntax(self):
 		# .SYNTAX
-		with Transaction(self, maybe=False, stage=".SYNTAX"):
-			syntax = self.needLiteral().lower()
-			self.syntax = syntax
-			return ".SYNTAX", syntax
+		syntax = self.needLiteral().lower()
+		self.syntax = syntax
+		return ".SYNTAX", syntax
 
+	@stage(".BYTE")
 	def handleByte(self):
 		# .DB / .BYTE / DB
-		with Transaction(self, maybe=False, stage=".BYTE"):
-			values = [self.needExpression()]
-			while self.needPunct(",", maybe=True):
-				values.append(self.needExpression())
-			return ".BYTE", values
+		values = [self.needExpression()]
+		while self.needPunct(",", maybe=True):
+			values.append(self.needExpression())
+		return ".BYTE", values
 
+	@stage(".WORD")
 	def handleWord(self):
 		# .DW / .WORD / DW
-		with Transaction(self, maybe=False, stage=".WORD"):
-			values = [self.needExpression()]
-			while self.needPunct(",", maybe=True):
-				values.append(self.needExpression())
-			return ".WORD", values
+		values = [self.needExpression()]
+		while self.needPunct(",", maybe=True):
+			values.append(self.needExpression())
+		return ".WORD", values
 
+	@stage(".DWORD")
 	def handleDword(self):
 		# .DWORD
-		with Transaction(self, maybe=False, stage=".DWORD"):
-			values = [self.needExpression()]
-			while self.needPunct(",", maybe=True):
-				values.append(self.needExpression())
-			return ".DWORD", values
+		values = [self.needExpression()]
+		while self.needPunct(",", maybe=True):
+			values.append(self.needExpression())
+		return ".DWORD", values
 
 	def handleEnd(self):
 		return ".END", None
 
+	@stage(".BLKB")
 	def handleBlkb(self):
 		# .DS / .BLKB / DS
-		with Transaction(self, maybe=False, stage=".BLKB"):
-			return ".BLKB", self.needExpression()
+		return ".BLKB", self.needExpression()
 
+	@stage(".BLKW")
 	def handleBlkw(self):
 		# .BLKW
-		with Transaction(self, maybe=False, stage=".BLKW"):
-			return ".BLKW", self.needExpression()
+		return ".BLKW", self.needExpression()
 
 	def handleEven(self):
 		# .EVEN
 		return ".EVEN", None
 
+	@stage(".ALIGN")
 	def handleAlign(self):
 		# ALIGN
-		with Transaction(self, maybe=False, stage=".ALIGN"):
-			return ".ALIGN", self.needExpression()
+		return ".ALIGN", self.needExpression()
 
+	@stage(".ASCII / .ASCIZ")
 	def handleAscii(self, term=""):
 		# .ASCII/.ASCIZ
-		with Transaction(self, maybe=False, stage=".ASCII / .ASCIZ"):
-			return ".ASCII", self.needString() + term
+		return ".ASCII", self.needString() + term
 
+	@stage(".MAKE_RAW")
 	def handleMakeRaw(self):
-		with Transaction(self, maybe=False, stage=".MAKE_RAW"):
-			return ".MAKE_RAW", self.needString(maybe=True)
+		return ".MAKE_RAW", self.needString(maybe=True)
 
+	@stage(".MAKE_BIN")
 	def handleMakeBin(self):
-		with Transaction(self, maybe=False, stage=".MAKE_BIN"):
-			return ".MAKE_BIN", self.needString(maybe=True)
+		return ".MAKE_BIN", self.needString(maybe=True)
 
+	@stage(".MAKE_SAV")
 	def handleMakeSav(self):
-		with Transaction(self, maybe=False, stage=".MAKE_SAV"):
-			filename = self.needString(maybe=True)
-			if filename is not None and self.needPunct(",", maybe=True):
-				final_address = self.needExpression()
-			else:
-				final_address = None
-			return ".MAKE_SAV", (filename, final_address)
+		filename = self.needString(maybe=True)
+		if filename is not None and self.needPunct(",", maybe=True):
+			final_address = self.needExpression()
+		else:
+			final_address = None
+		return ".MAKE_SAV", (filename, final_address)
 
+	@stage(".MAKE_TURBO_WAV")
 	def handleMakeTurboWav(self):
-		with Transaction(self, maybe=False, stage=".MAKE_TURBO_WAV"):
-			real_filename = self.needString(maybe=True)
-			if real_filename is not None and self.needPunct(",", maybe=True):
-				bk_filename = self.needString()
-			else:
-				bk_filename = None
-			return ".MAKE_TURBO_WAV", (real_filename, bk_filename)
+		real_filename = self.needString(maybe=True)
+		if real_filename is not None and self.needPunct(",", maybe=True):
+			bk_filename = self.needString()
+		else:
+			bk_filename = None
+		return ".MAKE_TURBO_WAV", (real_filename, bk_filename)
 
+	@stage(".MAKE_WAV")
 	def handleMakeWav(self):
-		with Transaction(self, maybe=False, stage=".MAKE_WAV"):
-			real_filename = self.needString(maybe=True)
-			if real_filename is not None and self.needPunct(",", maybe=True):
-				bk_filename = self.needString()
-			else:
-				bk_filename = None
-			return ".MAKE_WAV", (real_filename, bk_filename)
+		real_filename = self.needString(maybe=True)
+		if real_filename is not None and self.needPunct(",", maybe=True):
+			bk_filename = self.needString()
+		else:
+			bk_filename = None
+		return ".MAKE_WAV", (real_filename, bk_filename)
 
+	@stage(".CONVERT1251TOKOI8R")
 	def handleConvert1251toKOI8R(self):
-		with Transaction(self, maybe=False, stage=".CONVERT1251TOKOI8R"):
-			return ".CONVERT1251TOKOI8R", self.needBool()
+		return ".CONVERT1251TOKOI8R", self.needBool()
 
+	@stage(".DECIMALNUMBERS")
 	def handleDecimalNumbers(self):
-		with Transaction(self, maybe=False, stage=".DECIMALNUMBERS"):
-			self.decimal = self.needBool()
-			return ".DECIMALNUMBERS", self.decimal
+		self.decimal = self.needBool()
+		return ".DECIMALNUMBERS", self.decimal
 
+	@stage(".INSERT_FILE")
 	def handleInsertFile(self):
-		with Transaction(self, maybe=False, stage=".INSERT_FILE"):
-			return ".INSERT_FILE", self.needString()
+		return ".INSERT_FILE", self.needString()
 
+	@stage(".REPEAT")
 	def handleRepeat(self):
-		with Transaction(self, maybe=False, stage=".REPEAT"):
-			count = self.needExpression()
-
-			self.needPunct("{")
-			commands = []
-			cmd_start = self.cmd_start
-			while True:
-				if self.needPunct("}", maybe=True):
-					self.cmd_start = cmd_start
-					return ".REPEAT", (count, commands)
-				else:
-					for cmd in self.parseCommand():
-						commands.append(cmd)
+		count = self.needExpression()
+
+		self.needPunct("{")
+		commands = []
+		cmd_start = self.cmd_start
+		while True:
+			if self.needPunct("}", maybe=True):
+				self.cmd_start = cmd_start
+				return ".REPEAT", (count, commands)
+			else:
+				for cmd in self.parseCommand():
+					commands.append(cmd)
 
+	@stage(".EXTERN")
 	def handleExtern(self):
-		with Transaction(self, maybe=False, stage=".EXTERN"):
-			extern = [self.needLiteral()]
-			while self.needPunct(",", maybe=True):
-				extern.append(self.needLiteral())
+		extern = [self.needLiteral()]
+		while self.needPunct(",", maybe=True):
+			extern.append(self.needLiteral())
 
-			return ".EXTERN", extern
+		return ".EXTERN", extern
 
 	def handleOnce(self):
 		return ".ONCE", None
 
+	@stage("compilable command")
 	def handleCommand(self):
 		self.skipWhitespace()
 
-		with Transaction(self, maybe=False, stage="compilable command") as t:
-			command_name = self.needLiteral()
-
-			if command_name not in commands:
-				raise InvalidError(
-					"Expected command name, got '{command_name}'".format(command_name=command_name)
-				)
-
-			argtypes = commands[command_name][0]
-			args = []
-			for i, arg in enumerate(argtypes):
-				if i != 0:
-					self.needPunct(",")
-				if arg is A:
-					args.append(self.needArgument())
-				elif arg is D:
-					args.append(D(self.needExpression(isLabel=True)))
-				elif arg is I:
-					args.append(I(self.needExpression()))
-				elif arg is R:
-					args.append(self.needRegister())
-			return command_name, tuple(args)
+		command_name = self.needLiteral()
 
+		if command_name not in commands:
+			raise InvalidError(
+				"Expected command name, got '{command_name}'".format(command_name=command_name)
+			)
 
+		argtypes = commands[command_name][0]
+		args = []
+		for i, arg in enumerate(argtypes):
+			if i != 0:
+				self.needPunct(",")
+			if arg is A:
+				args.append(self.needArgument())
+			elif arg is D:
+				args.append(D(self.needExpression(isLabel=True)))
+			elif arg is I:
+				args.append(I(self.needExpression()))
+			elif arg is R:
+				args.append(self.needRegister())
+		return command_name, tuple(args)
+
+
+	@memoized("argument")
 	def needArgument(self, maybe=False):
 		# Parse Rn, (Rn) (as well as @Rn), (Rn)+, -(Rn), @(Rn)+, @-(Rn),
 		# expression(Rn), @expression(Rn), and PC shortcuts: #expression,
 		# @#expression, @expression and expression.
 
-		with Transaction(self, maybe=maybe, stage="argument") as t:
+		pos = self.pos
+		rollback = maybe
+		try:
 			if self.needPunct("(", maybe=True):
 				# (Rn) or (Rn)+
-				t.noRollback()
+				rollback = False
 				reg = self.needRegister()
 				self.needPunct(")")
 
@@ -445,11 +638,10 @@ class Parser(object):
 				expr = self.needExpression(maybe=True)
 				if expr is not None:
 					# @expression(Rn) or @expression
-					t.noRollback()
+					rollback = False
 
 					if self.needPunct("(", maybe=True):
 						# @expression(Rn)
-						t.noRollback()
 						reg = self.needRegister()
 						self.needPunct(")")
 						return A(reg, "@N(Rn)", expr)
@@ -462,12 +654,12 @@ class Parser(object):
 							return A(PC, "@N(Rn)", Expression.asOffset(expr))
 				elif self.needPunct("#", maybe=True):
 					# @#expression = @(PC)+
-					t.noRollback()
+					rollback = False
 					expr = self.needExpression()
 					return A(PC, "@(Rn)+", expr)
 				elif self.needPunct("(", maybe=True):
 					# @(Rn)+ or @(Rn)
-					t.noRollback()
+					rollback = False
 					reg = self.needRegister()
 					self.needPunct(")")
 					if self.needPunct("+", maybe=True):
@@ -475,15 +667,12 @@ class Parser(object):
 						return A(reg, "@(Rn)+")
 					else:
 						# @0(Rn)
-						coords = self.getCurrentCommandCoords()
 						return A(reg, "@N(Rn)", Expression(
-							0, self.file,
-							line=coords["line"],
-							column=coords["column"]
+							0, self.file, self.getCurrentCommandCoords()
 						))
 				elif self.needPunct("-", maybe=True):
 					# @-(Rn)
-					t.noRollback()
+					rollback = False
 					self.needPunct("(")
 					reg = self.needRegister()
 					self.needPunct(")")
@@ -497,10 +686,9 @@ class Parser(object):
 				expr = self.needExpression(maybe=True)
 				if expr is not None:
 					# expression(Rn) or expression
-					t.noRollback()
+					rollback = False
 					if self.needPunct("(", maybe=True):
 						# expression(Rn)
-						t.noRollback()
 						reg = self.needRegister()
 						self.needPunct(")")
 						return A(reg, "N(Rn)", expr)
@@ -509,24 +697,27 @@ class Parser(object):
 						return A(PC, "N(Rn)", Expression.asOffset(expr))
 				elif self.needPunct("-", maybe=True):
 					# -(Rn)
-					t.noRollback()
+					rollback = False
 					self.needPunct("(")
 					reg = self.needRegister()
 					self.needPunct(")")
 					return A(reg, "-(Rn)")
 				elif self.needPunct("#", maybe=True):
 					# #expression = (PC)+
-					t.noRollback()
+					rollback = False
 					expr = self.needExpression()
 					return A(PC, "(Rn)+", expr)
 				else:
 					# Rn
 					reg = self.needRegister()
 					return A(reg, "Rn")
+		except InvalidError as e:
+			return self.backtrack(e, pos, rollback, "argument")
 
 
 	def needRegister(self, maybe=False):
-		with Transaction(self, maybe=maybe, stage="register"):
+		pos = self.pos
+		try:
 			literal = self.needLiteral(maybe=True)
 			if not literal:
 				raise InvalidError("Expected register")
@@ -536,27 +727,27 @@ class Parser(object):
 				)
 			else:
 				return R(literal)
+		except InvalidError as e:
+			return self.backtrack(e, pos, maybe, "register")
 
 
 	def needExpression(self, isLabel=False, maybe=False):
-		with Transaction(self, maybe=maybe, stage="expression") as t:
+		pos = self.pos
+		rollback = maybe
+		try:
 			if self.syntax == "pdp11asm":
 				value = self.needValue(isLabel=isLabel)
 
-				t.noRollback()
+				rollback = False
 
 				while True:
 					if self.needPunct("+", maybe=True):
-						t.noRollback()
 						value += self.needValue(isLabel=isLabel)
 					elif self.needPunct("-", maybe=True):
-						t.noRollback()
 						value -= self.needValue(isLabel=isLabel)
 					elif self.needPunct("*", maybe=True):
-						t.noRollback()
 						value *= self.needValue(isLabel=isLabel)
 					elif self.needPunct("/", maybe=True):
-						t.noRollback()
 						value //= self.needValue(isLabel=isLabel)
 					else:
 						break
@@ -564,57 +755,47 @@ class Parser(object):
 				value.isOffset = False
 				return value
 			else:
-				if isLabel:
-					# First, analyze the expression. If it doesn't contain any
-					# brackets, we treat the first integer as a label and
-					# everything that follows as a number (Macro-11-compatible
-					# mode). If there ARE brackets, we treat all integers as
-					# numbers, and local labels must have a suffix of ":".
-
-					has_brackets = False
-
-					with Transaction(self, maybe=True):
-						while True:
-							if self.needPunct("(", maybe=True):
-								has_brackets = True
-								break
-
-							# Try reading value
-							self.needValue(isLabel=isLabel)
-
-							# Get operator
-							cur_char = self.needOperator(maybe=True)
-							if cur_char is None:
-								# Syntax error, handled later
-								break
-						raise InvalidError("Rollback")
-
-					if has_brackets:
-						# Labels must use ":" suffix
-						isLabel = False
-
-
-
-				def execute(char):
-					_, _, op = operators[char]
-					b = stack.pop()
-					a = stack.pop()
-					stack.append(op(a, b))
-
-				stack = []
+				# If the expression doesn't contain any brackets, we treat the
+				# first integer as a label and everything that follows as a
+				# number (Macro-11-compatible mode). If there ARE brackets, we
+				# treat all integers as numbers, and local labels must have a
+				# suffix of ":". To do that in one pass, the integer is read as
+				# a label first and re-read as a number when a bracket shows
+				# up. The expression is collected in reverse Polish notation,
+				# so that the value can be replaced before it's used.
+				output = []
 				op_stack = []
+				tentative = None
 
 				while True:
 					# Math opening bracket
 					while self.needPunct("(", maybe=True):
 						op_stack.append("(")
+						isLabel = False
+						if tentative is not None:
+							# Labels must use ":" suffix
+							index, value_pos = tentative
+							tentative = None
+							pos_after = self.pos
+							self.pos = value_pos
+							output[index] = self.needValue(isLabel=False)
+							self.pos = pos_after
 
 					# Really read value
+					value_pos = self.pos
 					value = self.needValue(isLabel=isLabel)
-					stack.append(value)
-					if isinstance(value, Deferred):
+					if isLabel and isinstance(value, Deferred):
 						# Only the first label is treated as a label
 						isLabel = False
+						label = integer_label_re.match(self.code, skip_re.match(self.code, value_pos).end())
+						if label is not None and isIntegerLike(label.group()):
+							tentative = (len(output), value_pos)
+					elif tentative is not None and self.code[self.pos - 1] == ":":
+						# This is a "1:"-style label. If it had been read as a
+						# label too, the expression would have ended here, so
+						# the brackets that follow don't count.
+						tentative = None
+					output.append(value)
 
 					# Match closing bracket
 					while "(" in op_stack and self.needPunct(")", maybe=True):
@@ -623,7 +804,7 @@ class Parser(object):
 							if top == "(":
 								break
 							else:
-								execute(top)
+								output.append(top)
 						else:
 							raise InvalidError("Unmatched ')'")
 
@@ -646,13 +827,13 @@ class Parser(object):
 						elif top_priority > cur_priority:
 							# If stack top priority is more than new priority,
 							# pop from stack top
-							execute(op_stack.pop())
+							output.append(op_stack.pop())
 						else:
 							# If stack top priority equals new priority, pop
 							# from stack top if the operator is left-associative,
 							# and break if it's right-associative
 							if top_assoc == "left":
-								execute(op_stack.pop())
+								output.append(op_stack.pop())
 							else:
 								break
 
@@ -664,27 +845,51 @@ class Parser(object):
 					if top == "(":
 						raise InvalidError("Unmatched '('")
 					else:
-						execute(top)
+						output.append(top)
 
+				# Evaluate. Values are ints or Deferreds, so strings are
+				# always operators.
+				stack = []
+				for item in output:
+					if isinstance(item, str):
+						_, _, op = operators[item]
+						b = stack.pop()
+						a = stack.pop()
+						stack.append(op(a, b))
+					else:
+						stack.append(item)
 				return stack.pop()
+		except InvalidError as e:
+			return self.backtrack(e, pos, rollback, "expression")
 
 
 	def needOperator(self, maybe=False):
-		with Transaction(self, maybe=maybe, stage="operator") as t:
-			operator_list = sorted(operators.keys(), key=len, reverse=True)
-			for operator in operator_list:
-				if self.needPunct(operator, maybe=True):
-					return operator
-			raise InvalidError("Expected operator")
+		pos = self.pos
+
+		# Skip whitespace
+		self.skipWhitespace()
 
+		match = operator_re.match(self.code, self.pos)
+		if match is None:
+			if maybe:
+				self.pos = pos
+				return None
+			self.backtrack(InvalidError("Expected operator"), pos, False, "operator")
+
+		self.pos = match.end()
+		return match.group()
+
+	@memoized("value")
 	def needValue(self, isLabel=False, maybe=False):
-		with Transaction(self, maybe=maybe, stage="value") as t:
+		pos = self.pos
+		rollback = maybe
+		try:
 			# Char (or two)
 			string = self.needString(maybe=True)
 			coords = self.getCurrentCommandCoords()
 
 			if string is not None:
-				t.noRollback()
+				rollback = False
 				try:
 					bts = encodeKoi8(string)
 				except UnicodeEncodeError:
@@ -698,9 +903,8 @@ class Parser(object):
 				elif len(bts) == 1:
 					return Expression(
 						ord(bts[0]) if sys.version_info[0] == 2 else bts[0],
-						coords["file"],
-						line=coords["line"],
-						column=coords["column"]
+						self.file,
+						coords
 					)
 				elif len(bts) == 2:
 					a, b = map(ord, bts) if sys.version_info[0] == 2 else bts
@@ -711,9 +915,8 @@ class Parser(object):
 						)
 					return Expression(
 						a | (b << 8),
-						coords["file"],
-						line=coords["line"],
-						column=coords["column"]
+						self.file,
+						coords
 					)
 				else:
 					raise InvalidError(
@@ -724,35 +927,24 @@ class Parser(object):
 					)
 
 			# Integer / local label
-			if isLabel:
-				local_label = self.needIntegerLabel(maybe=True)
-				if local_label is not None:
-					return Expression(
-						"{last_label}: {local_label}".format(last_label=self.last_label, local_label=local_label),
-						coords["file"],
-						line=coords["line"],
-						column=coords["column"]
-					)
-			else:
-				# Try to get an integer label. If it is an integer itself,
-				# there must be a colon next to it to be handled as a label
-				with Transaction(self, maybe=True):
-					local_label = self.needIntegerLabel()
-					# Handle raw integers (e.g. 123) which shouldn't be labels
-					# by default, as well as 0x..., 0b... and 0o... labels which
-					# are most likely meant to be integers
-					if (
-						local_label.isdigit() or
-						local_label.lower().startswith("0x") or
-						local_label.lower().startswith("0b") or
-						local_label.lower().startswith("0o")
-					):
-						self.needPunct(":")
+			label_pos = self.pos
+			local_label = self.needIntegerLabel(maybe=True)
+			if local_label is not None:
+				# If it's not a branch target, there must be a colon next to
+				# an integer to handle it as a label. Otherwise, raw integers
+				# (e.g. 123) shouldn't be labels, as well as 0x..., 0b... and
+				# 0o... labels which are most likely meant to be integers
+				if (
+					not isLabel and
+					isIntegerLike(local_label) and
+					self.needPunct(":", maybe=True) is None
+				):
+					self.pos = label_pos
+				else:
 					return Expression(
 						"{last_label}: {local_label}".format(last_label=self.last_label, local_label=local_label),
-						coords["file"],
-						line=coords["line"],
-						column=coords["column"]
+						self.file,
+						coords
 					)
 
 			# Integer
@@ -760,9 +952,8 @@ class Parser(object):
 			if integer is not None:
 				return Expression(
 					integer,
-					coords["file"],
-					line=coords["line"],
-					column=coords["column"]
+					self.file,
+					coords
 				)
 
 			# . (dot)
@@ -772,22 +963,26 @@ class Parser(object):
 			# STATIC_ALLOC[_BYTE]
 			literal = self.needLiteral(maybe=True)
 			if literal == "STATIC_ALLOC" or literal == "STATIC_ALLOC_BYTE":
-				t.noRollback()
-				with Transaction(self, maybe=False, stage=literal):
+				rollback = False
+				alloc_pos = self.pos
+				try:
 					self.needPunct("(")
 					length = self.needExpression()
 					self.needPunct(")")
 					return StaticAlloc(length, literal == "STATIC_ALLOC_BYTE")
+				except InvalidError as e:
+					self.backtrack(e, alloc_pos, False, literal)
 
 			# Label
 			if literal is None or literal in registers:
 				raise InvalidError("Expected integer, string, . (dot), label or STATIC_ALLOC[_BYTE]")
 			return Expression(
 				literal,
-				coords["file"],
-				line=coords["line"],
-				column=coords["column"]
+				self.file,
+				coords
 			)
+		except InvalidError as e:
+			return self.backtrack(e, pos, rollback, "value")
 
 
 
@@ -795,163 +990,149 @@ class Parser(object):
 		# Parse literal, starting with self.pos, and seek to
 		# its end. Return the literal in upper case.
 
-		with Transaction(self, maybe=maybe, stage="literal"):
-			# Skip whitespace
-			self.skipWhitespace(allow_eof=False)
+		pos = self.pos
+
+		# Skip whitespace
+		self.skipWhitespace()
 
-			literal = ""
+		if self.pos >= len(self.code):
+			error = "Unexpected EOF"
+			match = None
+		else:
+			match = literal_re.match(self.code, self.pos)
+			if match is None:
+				error = "Expected literal, got '{char}'".format(char=self.code[self.pos])
+			elif match.end() < len(self.code) and self.code[match.end()] not in delimiters:
+				error = "Expected literal, got '{char}'".format(char=self.code[match.end()])
+				match = None
 
-			while True:
-				try:
-					if self.code[self.pos] in whitespace + punctuation:
-						# Punctuation or whitespace
-						if literal == "":
-							raise InvalidError("Expected literal, got '{char}'".format(char=self.code[self.pos]))
-						return literal
-				except IndexError:
-					# End
-					if literal == "":
-						raise InvalidError("Expected literal, got EOF")
-					return literal
-
-				if self.code[self.pos].upper() in "ABCDEFGHIJKLMNOPQRSTUVWXYZ_$":
-					literal += self.code[self.pos].upper()
-					self.pos += 1
-				elif self.code[self.pos] in "0123456789" and literal != "":
-					literal += self.code[self.pos].upper()
-					self.pos += 1
-				else:
-					raise InvalidError("Expected literal, got '{char}'".format(char=self.code[self.pos]))
+		if match is None:
+			if maybe:
+				self.pos = pos
+				return None
+			self.backtrack(InvalidError(error), pos, False, "literal")
+
+		self.pos = match.end()
+		return match.group().upper()
 
 
 	def needPunct(self, char, maybe=False):
-		with Transaction(self, maybe=maybe, stage="sign '{char}'".format(char=char)):
-			# Skip whitespace
-			self.skipWhitespace()
+		pos = self.pos
 
-			if self.isEOF():
-				raise InvalidError("Expected '{exp}', got EOF".format(exp=char))
-			elif self.code[self.pos] == char:
-				self.pos += 1
-				return char
-			else:
-				raise InvalidError("Expected '{exp}', got '{char}'".format(exp=char, char=self.code[self.pos]))
+		# Skip whitespace
+		self.skipWhitespace()
+
+		if self.pos < len(self.code) and self.code[self.pos] == char:
+			self.pos += 1
+			return char
+		elif maybe:
+			self.pos = pos
+			return None
+		elif self.pos >= len(self.code):
+			error = "Expected '{exp}', got EOF".format(exp=char)
+		else:
+			error = "Expected '{exp}', got '{char}'".format(exp=char, char=self.code[self.pos])
+		self.backtrack(InvalidError(error), pos, False, "sign '{char}'", char=char)
 
 	def needChar(self, char, maybe=False):
-		with Transaction(self, maybe=maybe, stage="character '{char}'".format(char=char)):
-			try:
-				if self.code[self.pos].upper() == char:
-					self.pos += 1
-					return char
-				else:
-					raise InvalidError("Expected '{exp}', got '{char}'".format(exp=char, char=self.code[self.pos]))
-			except IndexError:
-				raise InvalidError("Expected '{char}', got EOF".format(char=char))
+		if self.pos < len(self.code) and self.code[self.pos].upper() == char:
+			self.pos += 1
+			return char
+		elif maybe:
+			return None
+		elif self.pos >= len(self.code):
+			error = "Expected '{char}', got EOF".format(char=char)
+		else:
+			error = "Expected '{exp}', got '{char}'".format(exp=char, char=self.code[self.pos])
+		self.backtrack(InvalidError(error), self.pos, False, "character '{char}'", char=char)
 
 
 	def needIntegerLabel(self, maybe=False):
-		with Transaction(self, maybe=maybe, stage="local label") as t:
-			# Skip whitespace
-			self.skipWhitespace()
+		pos = self.pos
 
-			# Try to get digit
-			label = ""
-			try:
-				if self.code[self.pos] in "0123456789":
-					label += self.code[self.pos]
-					self.pos += 1
-				else:
-					raise InvalidError("Expected digit, got '{char}'".format(char=self.code[self.pos]))
-			except IndexError:
-				raise InvalidError("Expected digit, got EOF")
+		# Skip whitespace
+		self.skipWhitespace()
 
-			# Get all the literal left
-			while True:
-				try:
-					if self.code[self.pos] in whitespace + punctuation:
-						# Punctuation or whitespace
-						break
-				except IndexError:
-					# End
-					break
+		# Label must start with a digit
+		match = integer_label_re.match(self.code, self.pos)
+		if match is None:
+			if self.pos >= len(self.code):
+				error = "Expected digit, got EOF"
+			else:
+				error = "Expected digit, got '{char}'".format(char=self.code[self.pos])
+		elif match.end() < len(self.code) and self.code[match.end()] not in delimiters:
+			error = "Expected literal, got '{char}'".format(char=self.code[match.end()])
+			match = None
 
-				if self.code[self.pos].upper() in "ABCDEFGHIJKLMNOPQRSTUVWXYZ_$0123456789":
-					label += self.code[self.pos].upper()
-					self.pos += 1
-				else:
-					raise InvalidError("Expected literal, got '{char}'".format(char=self.code[self.pos]))
+		if match is None:
+			if maybe:
+				self.pos = pos
+				return None
+			self.backtrack(InvalidError(error), pos, False, "local label")
 
-			return label
+		self.pos = match.end()
+		return match.group().upper()
 
 
 	def needInteger(self, maybe=False):
 		# Parse integer, starting with self.pos, and seek to
 		# its end. Return the integer in 'int' type.
 
-		with Transaction(self, maybe=maybe, stage="integer") as t:
+		pos = self.pos
+		rollback = maybe
+		try:
 			# Skip whitespace
 			self.skipWhitespace()
 
-			integer = ""
+			integer = None
 			radix = None
 
-			if self.needChar("+", maybe=True):
-				integer = "+"
-			elif self.needChar("-", maybe=True):
-				integer = "-"
+			# Most integers are just digits, maybe with a sign or a trailing
+			# dot
+			match = simple_integer_re.match(self.code, self.pos)
+			if match is not None:
+				end = match.end()
+				if match.group(1) is not None:
+					# Decimal
+					integer = match.group()[:-1]
+					radix = 10
+					self.pos = end
+				elif end >= len(self.code) or self.code[end] in delimiters:
+					integer = match.group()
+					self.pos = end
+
+			if integer is None:
+				# Radix prefixes, invalid digits and so on
+				integer = ""
+				if self.code.startswith("+", self.pos) or self.code.startswith("-", self.pos):
+					integer = self.code[self.pos]
+					self.pos += 1
 
-			while True:
-				if self.needChar(".", maybe=True):
+				word = word_re.match(self.code, self.pos).group()
+				for char in word:
+					upper = char.upper()
+					if radix is None and upper in radix_prefixes:
+						if integer != "0":
+							raise InvalidError("Expected integer, got '{int}{radix}'".format(int=integer, radix=upper.lower()))
+						radix = radix_prefixes[upper]
+						rollback = False
+					elif upper in "0123456789ABCDEF":
+						integer += upper
+					else:
+						raise InvalidError("Expected integer, got '{char}'".format(char=char))
+				self.pos += len(word)
+
+				if self.code.startswith(".", self.pos):
 					# Decimal
 					if integer == "":
 						raise InvalidError("Expected integer, got '.'")
 					elif radix is None:
 						radix = 10
-						break
+						self.pos += 1
 					else:
-						t.noRollback()
+						rollback = False
 						raise InvalidError("Two (or more) radix specifiers")
 
-				if radix is None:
-					if self.needChar("B", maybe=True):
-						# Binary
-						if integer != "0":
-							raise InvalidError("Expected integer, got '{int}b'".format(int=integer))
-						else:
-							radix = 2
-							t.noRollback()
-							continue
-					elif self.needChar("O", maybe=True):
-						# Octal
-						if integer != "0":
-							raise InvalidError("Expected integer, got '{int}o'".format(int=integer))
-						else:
-							radix = 8
-							t.noRollback()
-							continue
-					elif self.needChar("X", maybe=True):
-						# Hexadimical
-						if integer != "0":
-							raise InvalidError("Expected integer, got '{int}x'".format(int=integer))
-						else:
-							radix = 16
-							t.noRollback()
-							continue
-
-				try:
-					if self.code[self.pos] in whitespace + punctuation:
-						# Punctuation or whitespace
-						break
-				except IndexError:
-					# End
-					break
-
-				if self.code[self.pos].upper() in "0123456789ABCDEF":
-					integer += self.code[self.pos].upper()
-					self.pos += 1
-				else:
-					raise InvalidError("Expected integer, got '{char}'".format(char=self.code[self.pos]))
-
 			if radix is None:
 				radix = 10 if self.decimal else 8
 
@@ -959,111 +1140,72 @@ class Parser(object):
 				return int(integer, radix)
 			except ValueError:
 				raise InvalidError("Expected integer, got '{int}' (radix {radix})".format(int=integer, radix=radix))
+		except InvalidError as e:
+			return self.backtrack(e, pos, rollback, "integer")
 
 
 	def needRaw(self):
 		# Return string till the end of the string (trimmed)
 
-		with Transaction(self, maybe=False, stage="raw string (terminated by EOL)"):
-			string = ""
-
-			while True:
-				try:
-					if self.code[self.pos] in "\r\n":
-						# EOL
-						return string.strip()
-				except IndexError:
-					# EOF
-					return string.strip()
-
-				string += self.code[self.pos]
-				self.pos += 1
+		match = raw_re.match(self.code, self.pos)
+		self.pos = match.end()
+		return match.group().strip()
 
 
 	def needString(self, maybe=False):
 		# Return string between " and ", or / and /
 
-		with Transaction(self, maybe=maybe, stage="string") as t:
+		pos = self.pos
+		rollback = maybe
+		try:
 			mapped_at_least_once = False
-			string = ""
+			parts = []
 
 			while True:
 				# Skip whitespace
 				self.skipWhitespace()
 
-				if self.needChar("<", maybe=True):
+				if self.code.startswith("<", self.pos):
 					# Raw code
+					self.pos += 1
 					code = self.needInteger()
-					string += chr(code)
+					parts.append(chr(code))
 					self.needChar(">")
 					mapped_at_least_once = True
 					continue
 
 				if self.isEOF():
 					if mapped_at_least_once:
-						return string
+						return "".join(parts)
 					else:
 						raise InvalidError("Expected string, got EOF")
 
-				punct = ""
-				if self.code[self.pos] in "\"'/":
-					punct = self.code[self.pos]
+				punct = self.code[self.pos]
+				if punct in "\"'/":
 					self.pos += 1
-					t.noRollback()
+					rollback = False
 				else:
 					if mapped_at_least_once:
-						return string
+						return "".join(parts)
 					else:
-						raise InvalidError("Expected string, got '{char}'".format(char=self.code[self.pos]))
+						raise InvalidError("Expected string, got '{char}'".format(char=punct))
 
-				while True:
-					try:
-						#if self.code[self.pos] == "\\":
-						#	# Escape character
-						#	self.pos += 1
-						#
-						#	if self.code[self.pos] in "nN":
-						#		self.pos += 1
-						#		string += "\n"
-						#	elif self.code[self.pos] in "rR":
-						#		self.pos += 1
-						#		string += "\r"
-						#	elif self.code[self.pos] in "tT":
-						#		self.pos += 1
-						#		string += "\t"
-						#	elif self.code[self.pos] in "sS":
-						#		self.pos += 1
-						#		string += " "
-						#	elif self.code[self.pos] in "xX":
-						#		self.pos += 1
-						#		num = self.code[self.pos]
-						#		self.pos += 1
-						#		num += self.code[self.pos]
-						#		self.pos += 1
-						#		string += chr(int(num, 16))
-						#	elif self.code[self.pos] in "\\\"/":
-						#		self.pos += 1
-						#		string += self.code[self.pos]
-						#	else:
-						#		raise InvalidError("Expected \\n, \\r, \\t, \\s, \\\\, \\\", \\/ or \\xNN, got '\\{escape}'".format(escape=self.code[self.pos]))
-						if self.code[self.pos] == punct:
-							# End of string
-							self.pos += 1
-							mapped_at_least_once = True
-							break
-						else:
-							string += self.code[self.pos]
-							self.pos += 1
-					except IndexError:
-						# EOF
-						with Transaction(self, maybe=False):
-							raise InvalidError("Expected string terminator, got EOF")
+				end = self.code.find(punct, self.pos)
+				if end == -1:
+					raise InvalidError("Expected string terminator, got EOF", pos=len(self.code))
+
+				parts.append(self.code[self.pos:end])
+				self.pos = end + 1
+				mapped_at_least_once = True
+		except InvalidError as e:
+			return self.backtrack(e, pos, rollback, "string")
 
 
 	def needBool(self, maybe=False):
 		# Handle ON, OFF, TRUE, FALSE, YES, NO
 
-		with Transaction(self, maybe=maybe, stage="boolean"):
+		pos = self.pos
+		try:
 			# Skip whitespace
 			self.skipWhitespace()
 
@@ -1074,119 +1216,21 @@ class Parser(object):
 				return False
 			elif lit is not None:
 				raise InvalidError("Expected boolean, got '{boolean}'".format(boolean=lit))
+			elif self.pos >= len(self.code):
+				raise InvalidError("Expected boolean, got EOF")
 			else:
-				try:
-					raise InvalidError("Expected boolean, got '{boolean}'".format(boolean=self.code[self.pos]))
-				except IndexError:
-					raise InvalidError("Expected boolean, got EOF")
+				raise InvalidError("Expected boolean, got '{boolean}'".format(boolean=self.code[self.pos]))
+		except InvalidError as e:
+			return self.backtrack(e, pos, maybe, "boolean")
 
 	def isEOF(self):
-		pos = self.pos
-
-		# Skip whitespace
-		try:
-			self.skipWhitespace(allow_eof=False)
-		except InvalidError:
-			return True
-
-		self.pos = pos
-		return False
-
-	def skipWhitespace(self, allow_eof=True):
-		try:
-			skipped = True
-			while skipped:
-				skipped = False
+		return skip_re.match(self.code, self.pos).end() >= len(self.code)
 
-				# Skip whitespace
-				while self.code[self.pos] in whitespace:
-					skipped = True
-					self.pos += 1
-
-				# Skip ; comment
-				if self.code[self.pos] == ";":
-					# Comment
-					skipped = True
-					while self.code[self.pos] != "\n":
-						self.pos += 1
-
-				# Skip // comment
-				if self.code[self.pos:self.pos + 2] == "//":
-					# Comment
-					skipped = True
-					while self.code[self.pos] != "\n":
-						self.pos += 1
-		except IndexError:
-			if not allow_eof:
-				raise InvalidError("Unexpected EOF")
+	def skipWhitespace(self):
+		# Skip whitespace, ; comments and // comments
+		self.pos = skip_re.match(self.code, self.pos).end()
 
 
 	def getCurrentCommandCoords(self):
-		# Position to line/col
-		line = len(self.code[:self.cmd_start].split("\n"))
-		try:
-			last_lf = self.code[:self.cmd_start].rindex("\n")
-		except ValueError:
-			last_lf = 0
-		col = self.cmd_start - last_lf
-
-		return {
-			"file": self.file,
-			"line": line,
-			"column": col,
-			"text": self.code[self.cmd_start:self.pos].strip()
-		}
-
-
-class Transaction(object):
-	def __init__(self, parser, maybe=False, stage=None):
-		self.parser = parser
-		self.maybe = maybe
-		self.stage = stage
-
-	def __enter__(self):
-		self.pos = self.parser.pos
-		self.allow_rollback = True
-		self.parser.stage_stack.append(self.stage)
-		self.exitted = False
-		return self
-	def __exit__(self, err_cls, err, traceback):
-		stack = self.parser.stage_stack[:]
-		if not self.exitted:
-			self.parser.stage_stack.pop()
-
-		if err_cls is None:
-			# Success
-			return
-		elif isinstance(err, EndOfParsingError):
-			# It doesn't make sense to parse further
-			return False
-		elif isinstance(err, InvalidError):
-			# Could not parse token as ...
-			if self.parser.last_error_stages is None:
-				# Rollback to the place from which we couldn't match
-				self.parser.pos = self.pos
-				self.parser.last_error_stages = stack
-
-			if self.maybe and self.allow_rollback:
-				self.parser.pos = self.pos
-				self.parser.last_error_stages = None
-				return True
-			else:
-				return False
-		else:
-			# Some weird bug
-			return False
-
-	def reraise(self, exception):
-		self.parser.last_error_stages = self.parser.stage_stack[:]
-		raise exception
-
-	def noRollback(self):
-		# If encounter InvalidError, always reraise it
-		self.allow_rollback = False
-
-	def exit(self):
-		if not self.exitted:
-			self.parser.stage_stack.pop()
-		self.exitted = True
\ No newline at end of file
+		# Line/col are resolved lazily, see Coords
+		return Coords(self.file, self.lines, self.cmd_start, self.pos)
@@ -0,0 +1,352 @@
+from __future__ import print_function
+import io
+import os
+import contextlib
+from .deferred import Deferred
+from .commands import commands
+from .expression import Expression
+from .util import A, encodeKoi8
+
+# Two-pass engine (--two-pass). Pass 1 walks the program without writing
+# anything and computes label addresses as plain ints from the sizes of
+# commands. Pass 2 is the usual compilation, except that labels that are not
+# defined yet are looked up in these predictions, so forward references are
+# encoded right away instead of being linked later.
+#
+# If pass 1 meets a size or an address it can't compute as an int (e.g.
+# .BLKB sized by a label defined later), there are no predictions and the
+# program is compiled by the Deferred engine alone. Pass 2 checks each
+# prediction when the label is defined, and compilation starts again without
+# predictions if one is wrong or if pass 2 fails.
+
+
+class Unpredictable(Exception):
+	# Pass 1 can't compute an address
+	pass
+
+class Misprediction(Exception):
+	# Pass 2 disagrees with pass 1
+	pass
+
+
+def lookup(labels, leaf):
+	# Like Expression.Get.lookup(), but the key isn't remembered: pass 2
+	# looks the same leaves up in the compiler labels. Returns None unless
+	# the value is an int.
+	if not isinstance(leaf, Expression.Get):
+		return None
+	elif isinstance(leaf.s, int):
+		return leaf.s
+
+	for key in (leaf.s, "{file_id}:{s}".format(file_id=leaf.file_id, s=leaf.s)):
+		if key in labels:
+			value = labels[key]
+			return value if type(value) is int else None
+	return None
+
+
+def predict(compiler, roots):
+	# Pass 1. Returns (predictions, replays) or None, see Predictor.
+	predictor = Predictor(compiler)
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			for file in roots:
+				if compiler.project is not None:
+					# Project mode, see Compiler.buildProject()
+					predictor.PC = 0o1000
+					predictor.linkPC = 0o1000
+					file = compiler.resolve(file, os.getcwd())
+					predictor.include_root = file
+				else:
+					predictor.include_root = os.path.abspath(file)
+				predictor.addFile(file)
+	except (Unpredictable, SystemExit):
+		# SystemExit is a syntax error, it's reported by the Deferred engine
+		return None
+
+	return predictor.finish(), predictor.replays
+
+
+class Replay(object):
+	# Commands of a file as parsed by pass 1. Files are only parsed as far
+	# as they are compiled, e.g. up to .END.
+
+	def __init__(self, parser, code):
+		self.code = code
+		self.parser = parser
+		self.source = parser.parse()
+		self.records = []
+		self.finished = False
+
+	def walk(self):
+		# Yields (command, arg, labels, coords), parsing more if needed
+		idx = 0
+		while True:
+			if idx < len(self.records):
+				yield self.records[idx]
+				idx += 1
+				continue
+			elif self.finished:
+				return
+
+			try:
+				(command, arg), labels = next(self.source)
+			except StopIteration:
+				self.finished = True
+				return
+			self.records.append((command, arg, labels, self.parser.getCurrentCommandCoords()))
+
+
+class ReplayParser(object):
+	# Gives pass 2 the commands recorded by pass 1, so that files are not
+	# parsed twice. Marks (labels named .N) stay the same this way.
+
+	def __init__(self, file, replay):
+		self.file = file
+		self.replay = replay
+		self.coords = None
+
+	def parse(self):
+		for command, arg, labels, self.coords in self.replay.records:
+			yield (command, arg), labels
+		if not self.replay.finished:
+			# Pass 1 stopped earlier in this file
+			raise Misprediction()
+
+	def getCurrentCommandCoords(self):
+		return self.coords
+
+
+class Predictor(object):
+	# Mirrors Compiler.compileFile() and Compiler.handleCommand(), with ints
+	# for PC and labels
+
+	def __init__(self, compiler):
+		self.compiler = compiler
+		# Same keys as Compiler.labels, starting with -D defines. .EQU labels
+		# that can't be computed yet are None.
+		self.labels = dict(compiler.labels)
+		self.predicted = []
+		self.equs = []
+		self.replays = {}
+		self.PC = compiler.PC
+		self.linkPC = compiler.linkPC
+		self.include_root = None
+		self.extern_labels = False
+		self.included_before = set(compiler.included_before)
+		self.repeats = 0
+
+	def finish(self):
+		# .EQU labels may refer to labels defined after them
+		changed = True
+		while changed:
+			changed = False
+			for keys, value in self.equs:
+				if self.labels[keys[0]] is None:
+					try:
+						value = self.evaluate(value)
+					except Unpredictable:
+						continue
+					for key in keys:
+						self.labels[key] = value
+					changed = True
+
+		predictions = {}
+		for key in self.predicted:
+			value = self.labels[key]
+			if value is not None:
+				predictions[key] = value
+		return predictions
+
+	def evaluate(self, value):
+		# Returns the value as an int, or raises Unpredictable
+		if isinstance(value, Deferred):
+			try:
+				value = value.substitute(lambda leaf: lookup(self.labels, leaf))
+			except ArithmeticError:
+				raise Unpredictable()
+			if isinstance(value, Deferred) and value.cached:
+				value = value.cache
+		if type(value) is not int:
+			raise Unpredictable()
+		return value
+
+	def advance(self, length):
+		self.PC += length
+		self.linkPC += length
+
+	def addFile(self, file, relative_to=None):
+		if relative_to is None:
+			relative_to = os.getcwd()
+		else:
+			relative_to = os.path.dirname(relative_to)
+
+		file = self.compiler.resolve(file, relative_to)
+
+		if os.path.isdir(file):
+			for subfile in self.compiler.file_list:
+				if subfile.startswith(file + os.sep):
+					self.addFile(subfile, relative_to=self.compiler.project)
+			return
+
+		with open(file, "r", encoding="utf-8") as f:
+			code = f.read()
+
+		self.compileFile(file, code)
+
+	def compileFile(self, file, code):
+		replay = self.replays.get(file)
+		if replay is None or replay.code != code:
+			replay = Replay(self.compiler.createParser(file, code), code)
+			self.replays[file] = replay
+
+		extern_labels = self.extern_labels
+
+		self.extern_labels = False # .EXTERN NONE
+		try:
+			for command, arg, labels, _ in replay.walk():
+				try:
+					self.handleCommand(file, command, arg, labels)
+				except EOFError:
+					break
+		finally:
+			self.extern_labels = extern_labels
+
+	def include(self, path, file):
+		old_PC = self.PC
+		old_linkPC = self.linkPC
+
+		try:
+			self.addFile(path, relative_to=file)
+		except IOError:
+			raise Unpredictable()
+
+		self.linkPC = old_linkPC + (self.PC - old_PC)
+
+	def defineLabel(self, file_id, name, value, in_repeat):
+		if self.extern_labels is True:
+			extern = True
+		elif self.extern_labels is False:
+			extern = False
+		else:
+			extern = name in self.extern_labels
+
+		local_name = "{file_id}:{name}".format(file_id=file_id, name=name)
+		keys = [name, local_name] if extern else [local_name]
+		if name in self.labels or local_name in self.labels:
+			# Duplicate label, reported by the Deferred engine
+			raise Unpredictable()
+
+		if value is not None and type(value) is not int:
+			# .EQU
+			try:
+				value = self.evaluate(value)
+			except Unpredictable:
+				self.equs.append((keys, value))
+				value = None
+
+		for key in keys:
+			self.labels[key] = value
+		if not in_repeat:
+			# Labels inside .REPEAT get random names in pass 2
+			self.predicted += keys
+
+	def handleCommand(self, file, command, arg, labels, in_repeat=False):
+		for label in labels:
+			self.defineLabel(file, label, self.linkPC, in_repeat)
+
+		if command is None:
+			return
+		elif command == ".LINK":
+			if type(arg) is not int:
+				raise Unpredictable()
+			if self.include_root == file:
+				self.PC = arg
+			self.linkPC = arg
+		elif command == ".INCLUDE":
+			self.include(arg, file)
+		elif command in (".PDP11", ".SYNTAX", ".CONVERT1251TOKOI8R", ".DECIMALNUMBERS"):
+			pass
+		elif command in (".MAKE_RAW", ".MAKE_BIN", ".MAKE_SAV", ".MAKE_TURBO_WAV", ".MAKE_WAV"):
+			pass
+		elif command == ".BYTE":
+			self.advance(len(arg))
+		elif command == ".WORD":
+			self.advance(2 * len(arg))
+		elif command == ".DWORD":
+			self.advance(4 * len(arg))
+		elif command == ".END":
+			raise EOFError()
+		elif command == ".BLKB":
+			self.advance(max(self.evaluate(arg), 0))
+		elif command == ".BLKW":
+			self.advance(max(self.evaluate(arg) * 2, 0))
+		elif command == ".EVEN":
+			self.advance(self.linkPC % 2)
+		elif command == ".ALIGN":
+			arg = self.evaluate(arg)
+			if arg == 0:
+				raise Unpredictable()
+			self.advance(max(0 if self.linkPC % arg == 0 else arg - self.linkPC % arg, 0))
+		elif command == ".ASCII":
+			try:
+				self.advance(len(encodeKoi8(arg)))
+			except (UnicodeError, TypeError, AttributeError):
+				raise Unpredictable()
+		elif command == ".INSERT_FILE":
+			try:
+				self.advance(os.path.getsize(self.compiler.resolve(arg, os.path.dirname(file))))
+			except OSError:
+				raise Unpredictable()
+		elif command == ".EQU":
+			name, value = arg
+			self.defineLabel(file, name, value, in_repeat)
+		elif command == ".REPEAT":
+			count, repeat_commands = arg
+			count = self.evaluate(count)
+
+			local_labels = []
+			for _, labels in repeat_commands:
+				for name in labels:
+					if ": " not in name:
+						raise Unpredictable()
+				local_labels += labels
+
+			self.repeats += 1
+			for idx in range(count):
+				label_suffix = ": .REPEAT({id})[{idx}]".format(id=self.repeats, idx=idx)
+				for (command, arg), labels in repeat_commands:
+					arg = self.compiler.mapLabels(lambda label: label + label_suffix if label in local_labels else label, arg)
+					labels = [label + label_suffix for label in labels]
+					try:
+						self.handleCommand(file, command, arg, labels, in_repeat=True)
+					except EOFError:
+						break
+		elif command == ".EXTERN":
+			if "ALL" in arg or "NONE" in arg:
+				if len(set(arg)) > 1:
+					# Mixed .EXTERN, reported by the Deferred engine
+					raise Unpredictable()
+				self.extern_labels = arg[0] == "ALL"
+			else:
+				self.extern_labels = list(arg)
+		elif command == ".ONCE":
+			if file in self.included_before:
+				raise EOFError()
+			else:
+				self.included_before.add(file)
+		elif command not in commands:
+			# .I8080 and the like
+			raise Unpredictable()
+		elif callable(commands[command][1]):
+			# Metacommand
+			for sub_command, sub_arg in commands[command][1](*arg):
+				self.handleCommand(file, sub_command, sub_arg, [], in_repeat)
+		else:
+			# One word for the command and one for each immediate
+			# argument, see Compiler.handleCommand()
+			length = 2
+			for arg1 in arg:
+				if isinstance(arg1, A) and arg1.imm is not None:
+					length += 2
+			self.advance(length)
@@ -1,6 +1,8 @@
 from __future__ import print_function
 import sys
 import os
+import bisect
+import array
 from .deferred import Deferred
 from .turbowav import encodeTurboWav
 from .wav import encodeWav
@@ -140,6 +142,243 @@ def open_device(name, mode="r"):
 		return open(name, mode)
 
 
+class LineIndex(object):
+	# Maps offsets inside a file to line/column pairs. Line starts are
+	# collected once per file and searched with bisect, so that resolving a
+	# position does not depend on the file size.
+
+	def __init__(self, code):
+		self.code = code
+		self.line_starts = None
+
+	def locate(self, pos):
+		if self.line_starts is None:
+			self.line_starts = [0]
+			lf = self.code.find("\n")
+			while lf != -1:
+				self.line_starts.append(lf + 1)
+				lf = self.code.find("\n", lf + 1)
+
+		line = bisect.bisect_right(self.line_starts, pos)
+		if line == 1:
+			# There is no LF before the position
+			column = pos
+		else:
+			column = pos - self.line_starts[line - 1] + 1
+		return line, column
+
+	def __reduce__(self):
+		# The code is not saved, whoever loads coordinates supplies the index
+		# (see cache.StreamUnpickler)
+		return LineIndex, (None,)
+
+
+class Coords(object):
+	# Lazy source position. Behaves like a {"file", "line", "column", "text"}
+	# dict, but line, column and text are only computed when an error, a
+	# listing or whatever else actually reads them.
+
+	__slots__ = ("file", "index", "start", "end", "resolved")
+
+	def __init__(self, file, index, start, end):
+		self.file = file
+		self.index = index
+		self.start = start
+		self.end = end
+		self.resolved = None
+
+	def __getitem__(self, name):
+		if name == "file":
+			return self.file
+		elif name == "text":
+			return self.index.code[self.start:self.end].strip()
+
+		if self.resolved is None:
+			self.resolved = self.index.locate(self.start)
+		if name == "line":
+			return self.resolved[0]
+		elif name == "column":
+			return self.resolved[1]
+		else:
+			raise KeyError(name)
+
+	def __reduce__(self):
+		return Coords, (self.file, self.index, self.start, self.end)
+
+
+class MemoryImage(object):
+	# Output memory. Written bytes are kept in extents: sorted runs of bytes
+	# that neither overlap nor touch, each a bytearray. Memory and time
+	# depend on how much is written, not on the addresses (e.g. .LINK 140000).
+
+	def __init__(self):
+		self.starts = []
+		self.extents = []
+
+	def write(self, addr, data):
+		if not data:
+			return
+		i = bisect.bisect_right(self.starts, addr) - 1
+		if i >= 0 and self.starts[i] + len(self.extents[i]) >= addr:
+			# Overwrites or continues an extent. If data reaches past its end,
+			# the extent grows.
+			extent = self.extents[i]
+			offset = addr - self.starts[i]
+			extent[offset:offset + len(data)] = bytearray(data)
+		else:
+			i += 1
+			extent = bytearray(data)
+			self.starts.insert(i, addr)
+			self.extents.insert(i, extent)
+
+		# Merge the extents the write reached, the new bytes win
+		end = self.starts[i] + len(extent)
+		while i + 1 < len(self.starts) and self.starts[i + 1] <= end:
+			next_extent = self.extents[i + 1]
+			if self.starts[i + 1] + len(next_extent) > end:
+				extent += next_extent[end - self.starts[i + 1]:]
+				end = self.starts[i] + len(extent)
+			del self.starts[i + 1]
+			del self.extents[i + 1]
+
+	def read(self, start):
+		# Returns the bytes from start to the last written one as a list,
+		# gaps are zeroes
+		if not self.extents:
+			return []
+		end = self.starts[-1] + len(self.extents[-1])
+		if end <= start:
+			return []
+
+		output = bytearray(end - start)
+		i = max(bisect.bisect_right(self.starts, start) - 1, 0)
+		for extent_start, extent in zip(self.starts[i:], self.extents[i:]):
+			if extent_start >= start:
+				output[extent_start - start:extent_start - start + len(extent)] = extent
+			elif extent_start + len(extent) > start:
+				output[:extent_start + len(extent) - start] = extent[start - extent_start:]
+		return list(output)
+
+
+class Fill(object):
+	# .BLKB, .BLKW, .EVEN and .ALIGN padding: length zero bytes
+	__slots__ = ("length",)
+
+	def __init__(self, length):
+		self.length = length
+
+
+class WriteLog(object):
+	# Bytes written while compiling. Bytes whose address and value are
+	# already known take 3 bytes each: addresses go to an array("H"), values
+	# to a bytearray. Other writes are kept as (position, address, value)
+	# fixups, position being the number of known bytes written before, so
+	# that the write order (later writes win) is kept.
+
+	def __init__(self):
+		self.addresses = array.array("H")
+		self.values = bytearray()
+		self.fixups = []
+
+	def append(self, addr, value):
+		if isinstance(addr, Deferred) and addr.cached:
+			addr = addr.cache
+		if isinstance(value, Deferred) and value.cached:
+			value = value.cache
+
+		if type(addr) is int and 0 <= addr < 0x10000:
+			if type(value) is int and 0 <= value < 0x100:
+				self.addresses.append(addr)
+				self.values.append(value)
+				return
+			elif type(value) is list and addr + len(value) <= 0x10000 and all(type(byte) is int and 0 <= byte < 0x100 for byte in value):
+				self.addresses.extend(range(addr, addr + len(value)))
+				self.values.extend(value)
+				return
+		self.fixups.append((len(self.values), addr, value))
+
+	def appendFill(self, addr, length):
+		# Zero bytes are not stored, a Fill keeps their number (which may be
+		# a Deferred) until link()
+		self.fixups.append((len(self.values), addr, Fill(length)))
+
+	def __iter__(self):
+		# Yields (address, value) pairs in the order they were written.
+		# Known bytes at consecutive addresses come as one pair with a
+		# bytearray value.
+		position = 0
+		for fixup_position, addr, value in self.fixups:
+			for run in self.iterRuns(position, fixup_position):
+				yield run
+			position = fixup_position
+			yield addr, value
+		for run in self.iterRuns(position, len(self.values)):
+			yield run
+
+	def iterRuns(self, start, end):
+		addresses = self.addresses
+		while start < end:
+			run_end = start + 1
+			while run_end < end and addresses[run_end] == addresses[run_end - 1] + 1:
+				run_end += 1
+			yield addresses[start], self.values[start:run_end]
+			start = run_end
+
+
+class SymbolTable(dict):
+	# Labels by the key Expression.Get looks up: "NAME" for global labels,
+	# "file:NAME" for local ones. It's a dict, so that lookups stay as fast
+	# as they are. Each label is also recorded as (file, scope, name), file
+	# being None for global labels and scope the part of the name before the
+	# last ": " (e.g. "LOOP" for "LOOP: 1"), so that nothing has to split
+	# keys.
+
+	def __init__(self):
+		dict.__init__(self)
+		self.records = {}
+		# Full name -> files defining a local label with the name
+		self.files_by_name = {}
+		# File -> [(position, key)] of its local labels, in definition order
+		self.keys_by_file = {}
+
+	def define(self, file, name, value):
+		if file is None:
+			key = name
+		else:
+			key = "{file}:{name}".format(file=file, name=name)
+			self.files_by_name.setdefault(name, []).append(file)
+			self.keys_by_file.setdefault(file, []).append((len(self.records), key))
+
+		if ": " in name:
+			scope, local_name = name.rsplit(": ", 1)
+		else:
+			scope, local_name = None, name
+		self.records[key] = (file, scope, local_name)
+		self[key] = value
+		return key
+
+	def copy(self):
+		table = SymbolTable()
+		table.update(self)
+		table.records = dict(self.records)
+		table.files_by_name = dict((name, list(files)) for name, files in self.files_by_name.items())
+		table.keys_by_file = dict((file, list(keys)) for file, keys in self.keys_by_file.items())
+		return table
+
+	def findLocal(self, name):
+		# Returns the first file where a local label with the name is
+		# defined, or None
+		files = self.files_by_name.get(name)
+		return files[0] if files else None
+
+	def getName(self, key):
+		_, scope, name = self.records[key]
+		if scope is None:
+			return name
+		else:
+			return "{scope}: {name}".format(scope=scope, name=name)
+
+
 error_mode_sublime = False
 
 def raiseSyntaxError(file, line, column, stack=[], error=None):
@@ -202,15 +441,29 @@ def setErrorMode(sublime=True):
 
 
 class A(object):
+	# Operands without an immediate value, e.g. -(SP), are singletons
+	cache = {}
+	__slots__ = ("reg", "mode", "imm")
+	def __new__(cls, reg, mode, imm=None):
+		if imm is not None:
+			return object.__new__(cls)
+		try:
+			return cls.cache[(reg, mode)]
+		except KeyError:
+			inst = cls.cache[(reg, mode)] = object.__new__(cls)
+			return inst
 	def __init__(self, reg, mode, imm=None):
 		self.reg = reg
 		self.mode = mode
 		self.imm = imm
+	def __reduce__(self):
+		return A, (self.reg, self.mode, self.imm)
 	def __str__(self):
 		return self.mode.replace("Rn", str(self.reg)).replace("N", "({imm!r})".format(imm=self.imm))
 	def __repr__(self):
 		return str(self)
 class D(object):
+	__slots__ = ("addr",)
 	def __init__(self, addr):
 		self.addr = addr
 	def __str__(self):
@@ -218,6 +471,7 @@ class D(object):
 	def __repr__(self):
 		return str(self)
 class I(object):
+	__slots__ = ("value",)
 	def __init__(self, value):
 		self.value = value
 	def __str__(self):
@@ -238,6 +492,9 @@ class R(object):
 		return inst
 	def __init__(self, *names):
 		self.name = names[0]
+	def __reduce__(self):
+		# Registers are singletons
+		return R, (self.name,)
 	def __str__(self):
 		return self.name
 	def __repr__(self):
@@ -1,5 +1,5 @@
 @echo off
-python -m pdpy11 --sublime "%~1" --lst
+python -m pdpy11 --sublime "%~1" --lst --cache
 if errorlevel 1 (
     exit /b 1
 )
@@ -1,5 +1,5 @@
 #!/usr/bin/env bash
-python -m pdpy11 --sublime "$1" --lst || exit $?
+python -m pdpy11 --sublime "$1" --lst --cache || exit $?
 
 # cd /path/to/bk2010/
 # killall java
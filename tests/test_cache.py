@@ -0,0 +1,80 @@
+# --cache: parsed files are loaded instead of parsed, changed files are
+# parsed again only around the edit, and a new parser invalidates it all.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import shutil
+import tempfile
+import unittest
+
+from pdpy11.compiler.cache import ParseCache, IncrementalParser, CachedParser
+from pdpy11.compiler.parser import Parser
+from test_parser import describe
+
+
+code = "".join(
+	"L{i}: MOV #L{i} + 2, R0\n\tBNE L{i}\n\t.ASCIZ /{i}/\n\t.EVEN\n".format(i=i)
+	for i in range(20)
+)
+
+
+def parse(parser):
+	# Returns the commands as text and the line of each
+	commands = []
+	for command in parser.parse():
+		commands.append((describe(command), parser.getCurrentCommandCoords()["line"]))
+	return commands
+
+
+class TestCache(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_hit(self):
+		cache = ParseCache(self.directory)
+		parser = cache.open("test.mac", code, "pdpy11")
+		self.assertIsInstance(parser, IncrementalParser)
+		expected = parse(parser)
+
+		cache = ParseCache(self.directory)
+		parser = cache.open("test.mac", code, "pdpy11")
+		self.assertIsInstance(parser, CachedParser)
+		self.assertEqual((cache.hits, cache.misses), (1, 0))
+		self.assertEqual(parse(parser), expected)
+
+	def test_edit(self):
+		cache = ParseCache(self.directory)
+		old_parser = cache.open("test.mac", code, "pdpy11")
+		parse(old_parser)
+
+		# One more line in the middle
+		position = code.index("L10:")
+		new_code = code[:position] + "\tNOP\n" + code[position:]
+		parser = cache.open("test.mac", new_code, "pdpy11")
+		self.assertIsInstance(parser, IncrementalParser)
+		self.assertIsNotNone(parser.previous)
+		self.assertEqual(parse(parser), parse(Parser("test.mac", new_code, syntax="pdpy11")))
+
+		# Commands before the edit are the same records, commands after it
+		# are old records moved by the inserted text
+		self.assertEqual(parser.records[:10], old_parser.records[:10])
+		self.assertEqual(parser.records[-1][4], len("\tNOP\n"))
+
+	def test_parser_version(self):
+		cache = ParseCache(self.directory)
+		parse(cache.open("test.mac", code, "pdpy11"))
+
+		cache = ParseCache(self.directory)
+		cache.version = "another parser"
+		parser = cache.open("test.mac", code, "pdpy11")
+		self.assertIsInstance(parser, IncrementalParser)
+		self.assertIsNone(parser.previous)
+		self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+
+if __name__ == "__main__":
+	unittest.main()
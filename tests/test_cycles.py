@@ -0,0 +1,99 @@
+# Recursive label definitions must be reported with the whole cycle, even
+# when substituteLabels() has folded a label into the value of another one.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+from pdpy11.compiler import Compiler
+
+
+def link(code, file="test.mac"):
+	# Returns the first line printed by the failing link
+	compiler = Compiler()
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		compiler.compileFile(file, code)
+		compiler.link()
+	except SystemExit:
+		return sys.stdout.getvalue().split("\n")[0]
+	finally:
+		sys.stdout = stdout
+	return None
+
+
+class TestCycles(unittest.TestCase):
+	def test_two_labels(self):
+		self.assertEqual(
+			link("A = B + 1\nB = A + 1\n.WORD A\n"),
+			"Label A is recursively defined: A -> B -> A"
+		)
+
+	def test_three_labels(self):
+		self.assertEqual(
+			link(".WORD A\nA = B + 1\nB = C + 1\nC = A + 1\n"),
+			"Label A is recursively defined: A -> B -> C -> A"
+		)
+
+	def test_length_depends_on_label(self):
+		# A's address depends on the length of .BLKB A
+		self.assertEqual(
+			link(".BLKB A\nA: .WORD 0\n"),
+			"Label A is recursively defined: A -> A"
+		)
+
+	def test_alias(self):
+		self.assertEqual(
+			link("A = B + 1\nB = A\n.WORD A\n"),
+			"Label A is recursively defined: A -> B -> A"
+		)
+
+	def test_dot(self):
+		# . is a label named .N inside, it's shown with its place instead
+		self.assertEqual(
+			link(".BLKB B\nA = .\nB = A - 1000\n"),
+			"Label B is recursively defined: B -> . (test.mac:2) -> B"
+		)
+
+	def test_repeat(self):
+		self.assertEqual(
+			link("S: .WORD 0\n.REPEAT 1 {\n1$: .WORD 0\n.BLKB X\n}\nX = E - S\nE: .WORD 0\n"),
+			"Label X is recursively defined: X -> E -> X"
+		)
+
+	def test_repeat_label(self):
+		# Labels inside .REPEAT are named with a random suffix inside
+		self.assertEqual(
+			link("S: .WORD 0\n.REPEAT 2 {\n1$: .BLKB 2$\n2$: .WORD 0\n}\n"),
+			"Label S: 2$ (.REPEAT iteration 1) is recursively defined: " +
+			"S: 2$ (.REPEAT iteration 1) -> S: 2$ (.REPEAT iteration 1)"
+		)
+
+	def test_two_files(self):
+		directory = tempfile.mkdtemp()
+		try:
+			with io.open(os.path.join(directory, "b.mac"), "w", encoding="utf-8") as f:
+				f.write(u".EXTERN ALL\nB = A + 1\n.WORD 0\n")
+			file = os.path.join(directory, "a.mac")
+			self.assertEqual(
+				link(".EXTERN ALL\n.INCLUDE \"b.mac\"\nA = B + 1\n", file),
+				"Label B is recursively defined: B -> A ({file}) -> B".format(file=file)
+			)
+		finally:
+			shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	unittest.main()
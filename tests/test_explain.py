@@ -0,0 +1,87 @@
+# --explain-deferred: the dependency graph of labels and writes, with the
+# number of evaluations of each value.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import json
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+from pdpy11.compiler import Compiler
+from pdpy11.compiler.explain import Explainer
+
+
+class TestExplain(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def explain(self, code, format="json"):
+		# Returns the saved graph (parsed if it's JSON) and the summary, as
+		# __main__ does
+		explainer = Explainer()
+		explainer.install()
+		compiler = Compiler(explainer=explainer)
+		path = os.path.join(self.directory, "test.deferred." + format)
+
+		linked = False
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			compiler.compileFile("test.mac", code)
+			compiler.link()
+			linked = True
+		except SystemExit:
+			pass
+		finally:
+			explainer.uninstall()
+			explainer.build(linked)
+			explainer.write(path, format)
+			explainer.printSummary()
+			printed = sys.stdout.getvalue()
+			sys.stdout = stdout
+
+		with open(path) as f:
+			graph = json.load(f) if format == "json" else f.read()
+		return graph, printed
+
+	def test_graph(self):
+		graph, printed = self.explain(".WORD A\nA = B + 2\nB: .WORD 0\n")
+		nodes = dict((node["id"], node) for node in graph["nodes"])
+
+		a = nodes["label:test.mac:A"]
+		self.assertEqual((a["kind"], a["expr"], a["deps"]), ("label", "(B + 2)", ["label:test.mac:B"]))
+		self.assertEqual(a["evaluations"], 1)
+		self.assertEqual(nodes["label:test.mac:B"]["expr"], "1002")
+		self.assertEqual(nodes["write:0"]["name"], "write at 1000")
+		self.assertEqual(nodes["write:0"]["depth"], 4)
+
+		self.assertEqual(graph["deepest"][0][0], "write:0")
+		self.assertEqual(graph["deepest"][0][-2:], ["label:test.mac:A", "label:test.mac:B"])
+		self.assertEqual((graph["failure"], graph["cycles"]), ([], []))
+		self.assertIn("write at 1000 -> (2 values) -> test.mac:A -> test.mac:B", printed)
+
+	def test_failure(self):
+		graph, printed = self.explain("A = B + 1\nB = A + 1\n.WORD A\n")
+		self.assertEqual(graph["failure"], ["label:test.mac:A", "label:test.mac:B"])
+		self.assertIn("Failed while evaluating:\n  test.mac:A -> test.mac:B\n", printed)
+
+	def test_dot(self):
+		graph, _ = self.explain(".WORD A\nA = B + 2\nB: .WORD 0\n", "dot")
+		self.assertTrue(graph.startswith("digraph deferred {\n"))
+		self.assertIn("\t\"label:test.mac:A\" -> \"label:test.mac:B\";\n", graph)
+
+
+if __name__ == "__main__":
+	unittest.main()
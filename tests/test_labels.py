@@ -0,0 +1,87 @@
+# Labels: the symbol table, and values of forward references shared between
+# the places that use them.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import unittest
+
+from pdpy11.compiler import Compiler
+from pdpy11.compiler.parser import Parser
+from pdpy11.compiler.util import SymbolTable
+
+
+def parseValues(code):
+	# Returns the arguments of the first command
+	(command, arg), labels = next(Parser("test.mac", code, syntax="pdpy11").parse())
+	return arg
+
+
+class TestSymbolTable(unittest.TestCase):
+	def test_define(self):
+		table = SymbolTable()
+		self.assertEqual(table.define(None, "START", 0o1000), "START")
+		self.assertEqual(table.define("a.mac", "LOOP", 0o1002), "a.mac:LOOP")
+		self.assertEqual(table.define("a.mac", "LOOP: 1", 0o1004), "a.mac:LOOP: 1")
+		self.assertEqual(dict(table), {"START": 0o1000, "a.mac:LOOP": 0o1002, "a.mac:LOOP: 1": 0o1004})
+		self.assertEqual(table.records["a.mac:LOOP: 1"], ("a.mac", "LOOP", "1"))
+		self.assertEqual(table.keys_by_file, {"a.mac": [(1, "a.mac:LOOP"), (2, "a.mac:LOOP: 1")]})
+
+	def test_find_local(self):
+		table = SymbolTable()
+		table.define(None, "A", 0)
+		table.define("a.mac", "B", 0)
+		table.define("b.mac", "B", 0)
+		self.assertEqual(table.findLocal("B"), "a.mac")
+		self.assertIsNone(table.findLocal("A"))
+
+	def test_get_name(self):
+		table = SymbolTable()
+		table.define(None, "A", 0)
+		table.define("a.mac", "A: 1$", 0)
+		self.assertEqual(table.getName("A"), "A")
+		self.assertEqual(table.getName("a.mac:A: 1$"), "A: 1$")
+
+	def test_copy(self):
+		table = SymbolTable()
+		table.define("a.mac", "A", 0)
+		copy = table.copy()
+		copy.define("a.mac", "B", 2)
+		copy["a.mac:A"] = 1
+		self.assertEqual(dict(table), {"a.mac:A": 0})
+		self.assertEqual(list(table.records), ["a.mac:A"])
+		self.assertEqual(table.files_by_name, {"A": ["a.mac"]})
+		self.assertEqual(table.keys_by_file, {"a.mac": [(0, "a.mac:A")]})
+		self.assertEqual(copy.getName("a.mac:B"), "B")
+
+	def test_compiler(self):
+		compiler = Compiler()
+		compiler.compileFile("test.mac", ".EXTERN A\nA: B: 1: .WORD 0\n")
+		self.assertEqual(sorted(compiler.labels), ["A", "test.mac:A", "test.mac:B", "test.mac:B: 1"])
+		self.assertEqual(compiler.labels.findLocal("B"), "test.mac")
+
+
+class TestIntern(unittest.TestCase):
+	def test_same_subexpression(self):
+		compiler = Compiler()
+		a, b, c, d = [compiler.substituteLabels(value) for value in parseValues(".WORD A + 2, A + 2, A + 4, B + 2\n")]
+		self.assertIs(a, b)
+		self.assertIsNot(a, c)
+		self.assertIsNot(a, d)
+
+	def test_same_subexpression_in_two_commands(self):
+		compiler = Compiler()
+		a, = [compiler.substituteLabels(value) for value in parseValues(".WORD A - 1\n")]
+		b, = [compiler.substituteLabels(value) for value in parseValues(".WORD A - 1\n")]
+		self.assertIs(a, b)
+
+	def test_defined_label_is_not_interned(self):
+		compiler = Compiler()
+		compiler.compileFile("test.mac", "A: .WORD 0\n")
+		a, = [compiler.substituteLabels(value) for value in parseValues(".WORD A + 2\n")]
+		self.assertEqual(a, 0o1002)
+		self.assertEqual(compiler.interned, {})
+
+
+if __name__ == "__main__":
+	unittest.main()
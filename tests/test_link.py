@@ -0,0 +1,136 @@
+# Linking: the memory image, the write log and evaluating the graph of
+# labels and writes.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import unittest
+
+from pdpy11.compiler import Compiler
+from pdpy11.compiler import deferred
+from pdpy11.compiler.deferred import Deferred
+from pdpy11.compiler.util import WriteLog, Fill
+
+
+def compile(code):
+	compiler = Compiler()
+	compiler.compileFile("test.mac", code)
+	return compiler
+
+
+class TestWriteLog(unittest.TestCase):
+	def test_known_bytes(self):
+		writes = WriteLog()
+		writes.append(0o1000, 1)
+		writes.append(0o1001, [2, 3])
+		writes.append(0o1004, 4)
+		self.assertEqual(writes.fixups, [])
+		self.assertEqual(list(writes.addresses), [0o1000, 0o1001, 0o1002, 0o1004])
+		self.assertEqual(list(writes), [(0o1000, bytearray([1, 2, 3])), (0o1004, bytearray([4]))])
+
+	def test_fixups(self):
+		# Values that are not known bytes, or not at a known address
+		value = Deferred(lambda compiler: 5, int)
+		writes = WriteLog()
+		writes.append(0o1000, 1)
+		writes.append(0o1001, value)
+		writes.append(0o1002, 400)
+		writes.append(0o1003, [1, -1])
+		writes.append(0o177777, [1, 2])
+		writes.append(value, 2)
+		self.assertEqual(len(writes.values), 1)
+		self.assertEqual(writes.fixups, [
+			(1, 0o1001, value),
+			(1, 0o1002, 400),
+			(1, 0o1003, [1, -1]),
+			(1, 0o177777, [1, 2]),
+			(1, value, 2)
+		])
+
+	def test_cached_deferred(self):
+		writes = WriteLog()
+		writes.append(Deferred(0o1000, int), Deferred(7, int))
+		self.assertEqual(writes.fixups, [])
+		self.assertEqual(list(writes), [(0o1000, bytearray([7]))])
+
+	def test_order(self):
+		# Later writes win, so known bytes and fixups come in the order they
+		# were written
+		value = Deferred(lambda compiler: 5, int)
+		writes = WriteLog()
+		writes.append(0o1000, 1)
+		writes.append(0o1000, value)
+		writes.append(0o1000, 2)
+		writes.append(0o1001, 3)
+		writes.append(0o1000, value)
+		self.assertEqual(list(writes), [
+			(0o1000, bytearray([1])),
+			(0o1000, value),
+			(0o1000, bytearray([2, 3])),
+			(0o1000, value)
+		])
+
+
+class TestFill(unittest.TestCase):
+	def fills(self, compiler):
+		return [(addr, value.length) for _, addr, value in compiler.writes.fixups if type(value) is Fill]
+
+	def test_lengths(self):
+		compiler = compile(".BYTE 1\n.EVEN\n.BLKW 2\n.BLKB 3\n.EVEN\n.BLKB -3\nALIGN 10\n")
+		self.assertEqual(self.fills(compiler), [(0o1001, 1), (0o1002, 4), (0o1006, 3), (0o1011, 1), (0o1012, 0), (0o1012, 6)])
+		self.assertEqual(compiler.PC, 0o1020)
+		compiler.link()
+		self.assertEqual(list(compiler.output), [1] + [0] * 0o17)
+
+	def test_deferred_length(self):
+		# A negative length is 0, as [0] * length was
+		compiler = compile(".BLKB S\n.BLKB T\n.BYTE 7\nS = 2\nT = -2\n")
+		self.assertEqual(len(self.fills(compiler)), 2)
+		compiler.link()
+		self.assertEqual(list(compiler.output), [0, 0, 7])
+
+	def test_even(self):
+		# The padding byte is in the output, even at the end
+		compiler = compile(".BYTE 1, 2, 3\n.EVEN\n")
+		self.assertEqual(self.fills(compiler), [(0o1003, 1)])
+		compiler.link()
+		self.assertEqual(list(compiler.output), [1, 2, 3, 0])
+
+
+class TestWord(unittest.TestCase):
+	def test_forward_word_is_one_write(self):
+		# Both bytes come from one evaluation of the word
+		compiler = compile(".WORD A + 1\nA: .WORD 177777\n")
+		self.assertEqual(len(compiler.writes.fixups), 1)
+		compiler.link()
+		self.assertEqual(list(compiler.output), [0o3, 0o2, 0o377, 0o377])
+
+	def test_known_word_is_not_a_fixup(self):
+		compiler = compile("A: .WORD A + 1\n")
+		self.assertEqual(compiler.writes.fixups, [])
+
+
+class TestRelink(unittest.TestCase):
+	def test_second_link_is_cached(self):
+		compiler = compile(".WORD A + 1, B\n.BLKB S\nA: .BYTE B - A\nS = 3\nB: .WORD A\n")
+		compiler.link()
+		output = compiler.output
+
+		evaluate = deferred.evaluate
+		calls = []
+		def countingEvaluate(node, context):
+			calls.append(node)
+			return evaluate(node, context)
+
+		deferred.evaluate = countingEvaluate
+		try:
+			compiler.link()
+		finally:
+			deferred.evaluate = evaluate
+
+		self.assertEqual(compiler.output, output)
+		self.assertEqual(calls, [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,189 @@
+# The parser must give the same commands however it is tuned.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import sys
+import unittest
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+from pdpy11.compiler.compiler import make_directives
+from pdpy11.compiler.parser import Parser, scanDirectives
+from pdpy11.compiler.util import A, D, I
+
+
+code = (
+	"START: MOV #START + 2, R0 ; comment\n" +
+	"\tADD @(R1)+, -(R2)\n" +
+	"\tCMP 12.(R3), @#177560\n" +
+	"1:\tDEC R4\n" +
+	"\tBNE 1\n" +
+	"\t.WORD START - 2, (START + 1) * 2, -1\n" +
+	"\t.ASCIZ /text/\n" +
+	"\t.EVEN\n" +
+	"A = START + 10\n"
+)
+
+
+def describe(obj):
+	# Commands as text, with the immediate values that repr(A) leaves out
+	if isinstance(obj, (list, tuple)):
+		return "(" + ", ".join(describe(x) for x in obj) + ")"
+	elif isinstance(obj, A):
+		return "A({reg!r}, {mode}, {imm})".format(reg=obj.reg, mode=obj.mode, imm=describe(obj.imm))
+	elif isinstance(obj, D):
+		return "D({addr})".format(addr=describe(obj.addr))
+	elif isinstance(obj, I):
+		return "I({value})".format(value=describe(obj.value))
+	else:
+		return repr(obj)
+
+
+def parse(code, **kwargs):
+	# Returns the commands as text and the parser
+	parser = Parser("test.mac", code, syntax="pdpy11", **kwargs)
+	return [describe(command) for command in parser.parse()], parser
+
+
+def parseError(code):
+	# Returns the error and the place printed by the failing parse
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		parse(code)
+	except SystemExit:
+		return sys.stdout.getvalue().split("\n")[1:3]
+	finally:
+		sys.stdout = stdout
+	return None
+
+
+class TestMemo(unittest.TestCase):
+	def test_same_commands(self):
+		commands, _ = parse(code)
+		memo_commands, parser = parse(code, memoize=True)
+		self.assertEqual(commands, memo_commands)
+		self.assertGreater(parser.memo_misses, 0)
+
+	def test_off_by_default(self):
+		_, parser = parse(code)
+		self.assertEqual((parser.memo_hits, parser.memo_misses), (0, 0))
+
+
+class TestTokens(unittest.TestCase):
+	# Tokens are matched by regexes at the parser position, the same
+	# character may start different tokens
+	def assertCommands(self, code, expected):
+		commands, _ = parse(code)
+		self.assertEqual(commands[:-1], expected)
+		self.assertEqual(commands[-1], "((None, None), ())")
+
+	def test_slash(self):
+		self.assertCommands(".WORD 10/2\n.ASCII /a/<12>/b/\n", [
+			"(('.WORD', (4)), ())",
+			"(('.ASCII', 'a\\nb'), ())"
+		])
+
+	def test_comments(self):
+		self.assertCommands("HALT ; MOV\n.WORD 1 // 2\nNOP\n", [
+			"(('HALT', ()), ())",
+			"(('.WORD', (1)), ())",
+			"(('NOP', ()), ())"
+		])
+
+	def test_numbers(self):
+		self.assertCommands(".WORD 10, 10., -1., +7, 0x1F, 0b101, 0o17\n", [
+			"(('.WORD', (8, 10, -1, 7, 31, 5, 15)), ())"
+		])
+
+	def test_literals(self):
+		self.assertCommands("L1: DIV: .WORD $A, A$B, _X, 1$\n", [
+			"(('.WORD', ($A, A$B, _X, DIV: 1$)), ('L1', 'DIV'))"
+		])
+
+	def test_operators(self):
+		# << and >> are matched as a whole
+		self.assertCommands(".WORD A<<2, B >> 1, 1 + 2 * 3 - 4\n", [
+			"(('.WORD', ((A << 2), (B >> 1), 3)), ())"
+		])
+
+	def test_case(self):
+		self.assertCommands("mov -(sp), @2(r1)\norg 1000\ndb 1\n", [
+			"(('MOV', (A(SP, -(Rn), None), A(R1, @N(Rn), 2))), ())",
+			"(('.LINK', 512), ())",
+			"(('.BYTE', (1)), ())"
+		])
+
+	def test_unterminated_string(self):
+		self.assertEqual(parseError(".ASCII /abc\n"), [
+			"Expected string terminator, got EOF",
+			"  at file test.mac (line 2, column 1)"
+		])
+
+
+class TestExpression(unittest.TestCase):
+	def assertValues(self, code, expected):
+		commands, _ = parse(code)
+		self.assertEqual(commands[0], expected)
+
+	def test_priority(self):
+		self.assertValues(".WORD 2 * 3 + 4 * 5, 1 | 2 & 3, 1 + 2 << 1, 1 + 2 + 3 * (4 - 1)\n", "(('.WORD', (26, 3, 6, 12)), ())")
+
+	def test_left_associative(self):
+		self.assertValues(".WORD 10 - 2 - 3, 7 / 2 * 2, 100 % 7 % 3, A - B - C\n", "(('.WORD', (3, 6, 1, ((A - B) - C))), ())")
+
+	def test_brackets(self):
+		self.assertValues(".WORD (1 + 2) * (3 + 4), ((5)), (A + 1) * 2 - B\n", "(('.WORD', (21, 5, (((A + 1) * 2) - B))), ())")
+
+	def test_sign(self):
+		self.assertValues(".WORD 2 * -3, -3 + 1\n", "(('.WORD', (-6, -2)), ())")
+
+	def test_local_label(self):
+		# Without brackets the first integer is a label, with them it's a
+		# number unless it ends with ":"
+		self.assertValues("L: BR 1 + 2\n", "(('BR', (D((L: 1 + 2)))), ('L'))")
+		self.assertValues("L: BR 1 + (2)\n", "(('BR', (D(3))), ('L'))")
+		self.assertValues("L: MOV 1: + (2), R0\n", "(('MOV', (A(PC, N(Rn), (L: 1 + 2)), A(R0, Rn, None))), ('L'))")
+
+	def test_unmatched_brackets(self):
+		self.assertEqual(parseError(".WORD (1 + 2\n"), ["Unmatched '('", "  at file test.mac (line 1, column 5)"])
+		self.assertEqual(parseError(".WORD 1 + 2)\n"), ["Expected digit, got ')'", "  at file test.mac (line 1, column 11)"])
+
+	def test_missing_value(self):
+		self.assertEqual(parseError(".WORD 1 +\n")[0], "Expected integer, string, . (dot), label or STATIC_ALLOC[_BYTE]")
+
+
+class TestScanDirectives(unittest.TestCase):
+	# scanDirectives() must find a make directive whenever Parser.parse()
+	# does, otherwise a project root is silently not built
+	sources = [
+		".ASCII /{/\nmake_raw\n",
+		"S: .ASCII /{/\n.EVEN\nmake_raw\n",
+		".ASCIZ /a;/\nmake_bin\n",
+		".ASCII /a\n}/ <12> \"{\"\nmake_sav\n",
+		"make_wav \"a{\", /b{/\n.WORD 1\n",
+		".REPEAT 2 {\n.ASCII /}/\n}\nmake_raw\n",
+		".REPEAT 2 {\n.WORD 1\n}\n.END\nmake_raw\n",
+		"L: .WORD 1 ; {\nmake_raw\n"
+	]
+
+	def test_same_as_parser(self):
+		for code in self.sources:
+			parsed = [command for (command, _), _ in Parser("test.mac", code, syntax="pdpy11").parse()]
+			scanned = list(scanDirectives(code, "pdpy11"))
+			self.assertEqual(
+				any(command is not None and command.startswith(".MAKE_") for command in parsed),
+				any(directive in make_directives for directive in scanned),
+				code
+			)
+
+	def test_slash_string(self):
+		self.assertEqual(list(scanDirectives(".ASCII /{/\nmake_raw\n", "pdpy11")), [".ASCII", "MAKE_RAW"])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,76 @@
+# Project mode: include roots parsed in worker processes must build the
+# same as parsed one after another, with the same cache statistics.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+from pdpy11.compiler import Compiler
+from pdpy11.compiler.cache import ParseCache
+
+
+files = {
+	"main.mac": "make_raw\n.EXTERN ALL\nSTART: MOV #DATA, R0\n\tJMP @#OTHER\n\t.INCLUDE \"sub/inc.mac\"\nDATA: .WORD START, SUB + 2\n",
+	"second.mac": "make_raw\n.LINK 2000\n.EXTERN ALL\nOTHER: MOV #START, R0\n\t.WORD OTHER, DATA\n",
+	"sub/inc.mac": ".EXTERN ALL\nSUB: .BYTE 1, 2\n\t.EVEN\n",
+	"third.mac": "make_bin\n\t.ASCII /{/\n\t.EVEN\n\t.WORD SUB\n"
+}
+
+
+class TestParallelParse(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		for name, code in files.items():
+			path = os.path.join(self.directory, name)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with io.open(path, "w", encoding="utf-8") as f:
+				f.write(code)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def build(self, cpu_count, cache=None):
+		# Returns the outputs, (file, bytes) sorted by file
+		cpu_count_ = os.cpu_count
+		os.cpu_count = lambda: cpu_count
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			file_list = sorted(os.path.join(self.directory, name) for name in files)
+			compiler = Compiler(file_list=file_list, project=self.directory, cache=cache)
+			built = compiler.buildProject()
+		finally:
+			sys.stdout = stdout
+			os.cpu_count = cpu_count_
+		return sorted((file, bytes(output)) for _, file, _, output, _ in built)
+
+	def test_same_build(self):
+		serial = self.build(1)
+		self.assertEqual(len(serial), 3)
+		self.assertEqual(self.build(2), serial)
+
+	def test_cache_counters(self):
+		counters = []
+		for cpu_count in (1, 2):
+			cache = ParseCache(os.path.join(self.directory, ".cache{n}".format(n=cpu_count)))
+			self.build(cpu_count, cache)
+			self.build(cpu_count, cache)
+			counters.append((cache.hits, cache.misses))
+		self.assertEqual(counters[0], counters[1])
+		self.assertEqual(counters[0], (4, 4))
+
+
+if __name__ == "__main__":
+	unittest.main()
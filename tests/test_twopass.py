@@ -0,0 +1,89 @@
+# --two-pass must produce the same output and errors as the Deferred engine,
+# whether the predictions are used, not made, or wrong.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+from pdpy11.compiler import Compiler, twopass
+
+
+class TestTwoPass(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def build(self, code, two_pass):
+		# Returns (output, compiler), or (first printed line, None) on error
+		file = os.path.join(self.directory, "test.mac")
+		with io.open(file, "w", encoding="utf-8") as f:
+			f.write(code)
+
+		compiler = Compiler(two_pass=two_pass)
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			compiler.compileRoots([file])
+			compiler.link()
+		except SystemExit:
+			return sys.stdout.getvalue().split("\n")[0], None
+		finally:
+			sys.stdout = stdout
+		return compiler.output, compiler
+
+	def assertSameBuild(self, code):
+		output, _ = self.build(code, False)
+		two_pass_output, compiler = self.build(code, True)
+		self.assertEqual(output, two_pass_output)
+		return compiler
+
+	def test_forward_references_are_encoded(self):
+		compiler = self.assertSameBuild(
+			"START: MOV #DATA, R0\n" +
+			"BR NEXT\n" +
+			".REPEAT 2 {\n1: .WORD 1, DATA\n}\n" +
+			"NEXT: JMP @#DATA + 2\n" +
+			"SIZE = DATA - START\n" +
+			"DATA: .WORD SIZE, NEXT\n"
+		)
+		# Nothing was left for link()
+		self.assertEqual(compiler.writes.fixups, [])
+
+	def test_forward_size(self):
+		# .BLKB sized by a label defined later, pass 1 gives up
+		self.assertSameBuild(".BLKB SIZE\n.WORD END\nSIZE = 3\nEND: .WORD 0\n")
+
+	def test_error(self):
+		output, _ = self.build("BR FAR\n.BLKW 400\nFAR: HALT\n", True)
+		self.assertEqual(output, "Too far branch: 400 words")
+
+	def test_misprediction(self):
+		predict = twopass.predict
+		def wrongPredict(compiler, roots):
+			predictions, replays = predict(compiler, roots)
+			for name in predictions:
+				predictions[name] += 2
+			return predictions, replays
+
+		twopass.predict = wrongPredict
+		try:
+			self.assertSameBuild(".WORD A\nA: .WORD B\nB: .WORD A\n")
+		finally:
+			twopass.predict = predict
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,112 @@
+# Helpers of util.py: line/column lookup, lazy coordinates and the output
+# memory.
+#
+# Run with: python -m unittest discover tests
+
+from __future__ import print_function
+import unittest
+
+from pdpy11.compiler.parser import Parser
+from pdpy11.compiler.util import LineIndex, Coords, MemoryImage
+
+
+def locate(code, pos):
+	# The line/column pair the parser reported before LineIndex existed
+	line = len(code[:pos].split("\n"))
+	try:
+		last_lf = code[:pos].rindex("\n")
+	except ValueError:
+		last_lf = 0
+	return line, pos - last_lf
+
+
+class TestLineIndex(unittest.TestCase):
+	def test_same_as_split(self):
+		code = "A: .WORD 0\n\n\tMOV R0, R1\nB:\n.END"
+		index = LineIndex(code)
+		for pos in range(len(code) + 1):
+			self.assertEqual(index.locate(pos), locate(code, pos), pos)
+
+	def test_no_line_feed(self):
+		self.assertEqual(LineIndex("HALT").locate(2), (1, 2))
+
+	def test_trailing_line_feed(self):
+		self.assertEqual(LineIndex("HALT\n").locate(5), (2, 1))
+
+
+class TestCoords(unittest.TestCase):
+	def test_fields(self):
+		coords = Coords("test.mac", LineIndex("HALT\n  MOV R0, R1  \nNOP\n"), 7, 19)
+		self.assertEqual(coords["file"], "test.mac")
+		self.assertEqual(coords["line"], 2)
+		self.assertEqual(coords["column"], 3)
+		self.assertEqual(coords["text"], "MOV R0, R1")
+		with self.assertRaises(KeyError):
+			coords["offset"]
+
+	def test_lazy(self):
+		# Nothing is located until line or column is read
+		index = LineIndex("HALT\nNOP\n")
+		coords = Coords("test.mac", index, 5, 8)
+		self.assertEqual(coords["text"], "NOP")
+		self.assertIsNone(index.line_starts)
+		self.assertIsNone(coords.resolved)
+		self.assertEqual(coords["line"], 2)
+		self.assertEqual(coords.resolved, (2, 1))
+
+	def test_parser(self):
+		code = "A: .WORD 0\n\tMOV R0, R1\n"
+		parser = Parser("test.mac", code, syntax="pdpy11")
+		coords = []
+		for (command, _), _ in parser.parse():
+			if command is not None:
+				coords.append(parser.getCurrentCommandCoords())
+		self.assertEqual([(c["line"], c["column"], c["text"]) for c in coords], [
+			(1, 3, ".WORD 0"),
+			(2, 2, "MOV R0, R1")
+		])
+
+
+class TestMemoryImage(unittest.TestCase):
+	def image(self, *writes):
+		memory = MemoryImage()
+		for addr, data in writes:
+			memory.write(addr, data)
+		return memory
+
+	def test_gaps(self):
+		memory = self.image((0o1004, [5, 6]), (0o1000, [1]))
+		self.assertEqual(memory.starts, [0o1000, 0o1004])
+		self.assertEqual(memory.read(0o1000), [1, 0, 0, 0, 5, 6])
+		self.assertEqual(memory.read(0o1005), [6])
+		self.assertEqual(memory.read(0o1006), [])
+		self.assertEqual(MemoryImage().read(0), [])
+
+	def test_read_before_first_write(self):
+		self.assertEqual(self.image((0o1002, [7])).read(0o1000), [0, 0, 7])
+
+	def test_touching_writes_merge(self):
+		memory = self.image((0o1000, [1, 2]), (0o1004, [5]), (0o1002, [3, 4]))
+		self.assertEqual(memory.starts, [0o1000])
+		self.assertEqual(memory.read(0o1000), [1, 2, 3, 4, 5])
+
+	def test_later_writes_win(self):
+		memory = self.image((0o1000, [1, 2, 3]), (0o1006, [7, 8]), (0o1002, [9, 9, 9, 9, 9]))
+		self.assertEqual(memory.starts, [0o1000])
+		self.assertEqual(memory.read(0o1000), [1, 2, 9, 9, 9, 9, 9, 8])
+
+		memory = self.image((0o1002, [1, 2]), (0o1000, [9, 9, 9, 9, 9, 9]))
+		self.assertEqual(memory.read(0o1000), [9, 9, 9, 9, 9, 9])
+
+	def test_empty_write(self):
+		self.assertEqual(self.image((0o1000, [])).starts, [])
+
+	def test_high_address(self):
+		# Memory depends on the bytes written, not on the addresses
+		memory = self.image((0o140000, [1]), (0o177776, [2, 3]))
+		self.assertEqual([len(extent) for extent in memory.extents], [1, 2])
+		self.assertEqual(len(memory.read(0o140000)), 0o40000)
+
+
+if __name__ == "__main__":
+	unittest.main()